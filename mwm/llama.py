@@ -2,8 +2,8 @@ import os
 from shutil import copyfile
 from typing import Any, Dict, List, Optional, Tuple, Union
 import json
-import tempfile
 from functools import partial
+from itertools import groupby
 
 import numpy as np
 import jax
@@ -14,7 +14,6 @@ from jax.sharding import PartitionSpec as PS
 from jax.experimental.shard_map import shard_map
 import flax.linen as nn
 from flax.core.frozen_dict import FrozenDict, freeze, unfreeze
-from flax.linen import combine_masks, make_causal_mask
 from flax.traverse_util import flatten_dict, unflatten_dict
 from flax.linen import partitioning as nn_partitioning
 
@@ -27,26 +26,16 @@ from transformers.modeling_flax_utils import FlaxPreTrainedModel
 from transformers.utils import add_start_docstrings, add_start_docstrings_to_model_forward, logging
 
 from ml_collections import ConfigDict
-from tux import function_args_to_config, load_pickle, open_file,  with_sharding_constraint, get_jax_mesh, get_gradient_checkpoint_policy
+from tux import function_args_to_config, load_pickle, open_file,  with_sharding_constraint, get_jax_mesh, get_gradient_checkpoint_policy, \
+    get_float_dtype_by_name
 from mwm.ring_attention import blockwise_ffn, ring_flash_attention_tpu, \
-    ring_attention_standard, ring_attention
+    ring_attention_standard, ring_attention, standard_attention
 
 
-# Move torch functions in S6 to jax.numpy
-from torch.nn import functional as F
-from einops import rearrange, repeat
-
-
-USE_MAMBA = 1
-USE_TRANSFORMER = ~USE_MAMBA
-DIFFERENT_H_STATES_RECURRENT_UPDATE_MECHANISM = 0
-
-# Mamba hyperparameters
-# User hyperparameters
-d_model = 16
-state_size = 1024  # Example state size
-seq_len = 100  # Example sequence length
-batch_size = 128  # Example batch size
+# Backbone selection, 'transformer' or 'mamba'. The mamba backbone stacks MambaBlocks on the transformer blocks
+MODEL_BACKBONE = os.environ.get('MIVRA_BACKBONE', 'transformer')
+USE_MAMBA = MODEL_BACKBONE == 'mamba'
+USE_TRANSFORMER = not USE_MAMBA
 
 
 
@@ -182,6 +171,25 @@ class LLaMAConfig(PretrainedConfig):
             relevant if `config.is_decoder=True`.
         tie_word_embeddings(`bool`, *optional*, defaults to `False`):
             Whether to tie weight embeddings
+        param_dtype (`str`, *optional*, defaults to `""`):
+            Storage dtype of the attention and MLP projection kernels, e.g. `"bf16"`. Empty to use the module
+            param_dtype. Norm weights always keep the module param_dtype.
+        compute_dtype (`str`, *optional*, defaults to `""`):
+            Compute dtype of the attention and MLP projections, empty to use the model dtype.
+        contiguous_position_ids (`bool`, *optional*, defaults to `False`):
+            Whether every row of `position_ids` is the same contiguous range. Lets RoPE read its tables with a
+            dynamic slice instead of a gather. Must stay off for left padded batches, generation rejects a padding
+            attention mask and skips bucket padding of the prompt when it is set.
+        scan_remat_block (`str`, *optional*, defaults to `""`):
+            Checkpoint policy of the scanned decoder layer when `scan_layers` is set and `remat_block` is empty,
+            e.g. `"nothing_saveable"`. Empty to scan without rematerialization.
+        strict_partition (`bool`, *optional*, defaults to `False`):
+            Raise on params not covered by a partition rule instead of replicating them.
+        kv_cache_dtype (`str`, *optional*, defaults to `""`):
+            Storage dtype of the decoding key/value cache, e.g. `"bf16"` or `"fp8"` (float8_e5m2). Cached keys and
+            values are cast back to the attention dtype when read. Empty to store them in the attention dtype.
+        mamba_state_size (`int`, *optional*, defaults to 1024):
+            Size of the S6 state per channel of the Mamba blocks, used when `MIVRA_BACKBONE=mamba`.
         Example:
     ```python
     >>> from transformers import LLaMAModel, LLaMAConfig
@@ -224,7 +232,15 @@ class LLaMAConfig(PretrainedConfig):
         fcm_max_ratio=0.0,
         scan_layers=True,
         param_scan_axis=0,
+        scan_checkpoint_groups=0,
+        scan_remat_block='',
+        strict_partition=False,
+        kv_cache_dtype='',
         mesh_dim=None,
+        param_dtype='',
+        compute_dtype='',
+        contiguous_position_ids=False,
+        mamba_state_size=1024,
         use_flash_attention=True,
         theta=10000,
         **kwargs,
@@ -254,7 +270,15 @@ class LLaMAConfig(PretrainedConfig):
         self.fcm_max_ratio = fcm_max_ratio
         self.scan_layers = scan_layers
         self.param_scan_axis = param_scan_axis
+        self.scan_checkpoint_groups = scan_checkpoint_groups
+        self.scan_remat_block = scan_remat_block
+        self.strict_partition = strict_partition
+        self.kv_cache_dtype = kv_cache_dtype
         self.mesh_dim = mesh_dim
+        self.param_dtype = param_dtype
+        self.compute_dtype = compute_dtype
+        self.contiguous_position_ids = contiguous_position_ids
+        self.mamba_state_size = mamba_state_size
         self.use_flash_attention = use_flash_attention
         self.theta = theta
         super().__init__(
@@ -294,72 +318,77 @@ class LLaMAConfig(PretrainedConfig):
 
 
     @staticmethod
-    def get_partition_rules(scan_layers=False, scan_axis=0):
+    def get_partition_rules(scan_layers=False, scan_axis=0, strict=False):
         """ Parition rules for GPTJ. Note that these rules are orderd, so that
             the beginning rules match first. It is important to use
             PartitionSpec() instead of None here because JAX does not treat
-            None as a pytree leaf.
+            None as a pytree leaf. With strict, params matching no rule raise
+            instead of being silently replicated.
         """
+        fallback = () if strict else (('.*', PS(None)),)
         if scan_layers:
             if scan_axis == 0:
                 return (
                     # embeddings
-                    ("transformer/wte/embedding", PS("tp", ("fsdp", "sp"))),
+                    ("(transformer|transmamba)/wte/embedding", PS("tp", ("fsdp", "sp"))),
                     # atention
-                    ("attention/(wq|wk|wv)/kernel", PS(None, ("fsdp", "sp"), "tp")),
+                    ("attention/wqkv/kernel", PS(None, ("fsdp", "sp"), "tp")),
                     ("attention/wo/kernel", PS(None, "tp", ("fsdp", "sp"))),
                     # mlp
-                    ("feed_forward/w1/kernel", PS(None, ("fsdp", "sp"), "tp")),
+                    ("feed_forward/w13/kernel", PS(None, ("fsdp", "sp"), "tp")),
                     ("feed_forward/w2/kernel", PS(None, "tp", ("fsdp", "sp"))),
-                    ("feed_forward/w3/kernel", PS(None, ("fsdp", "sp"), "tp")),
                     # layer norms
                     ("attention_norm/kernel", PS(None, None)),
                     ("ffn_norm/kernel", PS(None, None)),
                     # output head
-                    ("transformer/ln_f/kernel", PS(None)),
+                    ("(transformer|transmamba)/ln_f/kernel", PS(None)),
                     ("lm_head/kernel", PS(("fsdp", "sp"), "tp")),
-                    ('.*', PS(None)),
-                )
+                    # mamba backbone, small enough to replicate
+                    ("mamba_blocks/", PS(None)),
+                    ("transmamba/final_proj/", PS(None)),
+                ) + fallback
             elif scan_axis == 1:
                 return (
                     # embeddings
-                    ("transformer/wte/embedding", PS("tp", ("fsdp", "sp"))),
+                    ("(transformer|transmamba)/wte/embedding", PS("tp", ("fsdp", "sp"))),
                     # atention
-                    ("attention/(wq|wk|wv)/kernel", PS(("fsdp", "sp"), None, "tp")),
+                    ("attention/wqkv/kernel", PS(("fsdp", "sp"), None, "tp")),
                     ("attention/wo/kernel", PS("tp", None, ("fsdp", "sp"))),
                     # mlp
-                    ("feed_forward/w1/kernel", PS(("fsdp", "sp"), None, "tp")),
+                    ("feed_forward/w13/kernel", PS(("fsdp", "sp"), None, "tp")),
                     ("feed_forward/w2/kernel", PS("tp", None, ("fsdp", "sp"))),
-                    ("feed_forward/w3/kernel", PS(("fsdp", "sp"), None, "tp")),
                     # layer norms
                     ("attention_norm/kernel", PS(None, None)),
                     ("ffn_norm/kernel", PS(None, None)),
                     # output head
-                    ("transformer/ln_f/kernel", PS(None)),
+                    ("(transformer|transmamba)/ln_f/kernel", PS(None)),
                     ("lm_head/kernel", PS(("fsdp", "sp"), "tp")),
-                    ('.*', PS(None)),
-                )
+                    # mamba backbone, small enough to replicate
+                    ("mamba_blocks/", PS(None)),
+                    ("transmamba/final_proj/", PS(None)),
+                ) + fallback
             else:
                 raise ValueError(f"Invalid scan_axis {scan_axis}")
         else:
             return (
                 # embeddings
-                ("transformer/wte/embedding", PS("tp", ("fsdp", "sp"))),
+                ("(transformer|transmamba)/wte/embedding", PS("tp", ("fsdp", "sp"))),
                 # atention
-                ("attention/(wq|wk|wv)/kernel", PS(("fsdp", "sp"), "tp")),
+                ("attention/wqkv/kernel", PS(("fsdp", "sp"), "tp")),
                 ("attention/wo/kernel", PS("tp", ("fsdp", "sp"))),
                 # mlp
-                ("feed_forward/w1/kernel", PS(("fsdp", "sp"), "tp")),
+                ("feed_forward/w13/kernel", PS(("fsdp", "sp"), "tp")),
                 ("feed_forward/w2/kernel", PS("tp", ("fsdp", "sp"))),
-                ("feed_forward/w3/kernel", PS(("fsdp", "sp"), "tp")),
                 # layer norms
                 ("attention_norm/kernel", PS(None)),
                 ("ffn_norm/kernel", PS(None)),
                 # output head
-                ("transformer/ln_f/kernel", PS(None)),
+                ("(transformer|transmamba)/ln_f/kernel", PS(None)),
                 ("lm_head/kernel", PS(("fsdp", "sp"), "tp")),
-                ('.*', PS(None)),
-            )
+                # mamba backbone, small enough to replicate
+                ("mamba_blocks/", PS(None)),
+                ("transmamba/final_proj/", PS(None)),
+            ) + fallback
 
     @staticmethod
     def get_weight_decay_exclusions():
@@ -435,7 +464,8 @@ class RMSNorm(nn.Module):
         )
 
     def _norm(self, x: jnp.ndarray) -> jnp.ndarray:
-        return x * jax.lax.rsqrt(jnp.square(x).mean(-1, keepdims=True) + self.eps)
+        inv = jax.lax.rsqrt(jnp.mean(jax.lax.square(x), axis=-1, keepdims=True) + self.eps)
+        return x * inv
 
     def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
         x = x.astype(jnp.promote_types(self.dtype, jnp.float32))
@@ -444,38 +474,70 @@ class RMSNorm(nn.Module):
         return output * weight
 
 
-def precompute_freqs_cis(dim: int, max_position_embedding: int, theta: float=10000.0, dtype: jnp.dtype=jnp.float32) -> jnp.ndarray:
-    freqs = 1.0 / (theta ** (np.arange(0, dim, 2)[: (dim // 2)].astype(dtype) / dim))
-    t = np.arange(max_position_embedding) # type: ignore
-    freqs = np.outer(t, freqs).astype(dtype)  # type: ignore
-    sin, cos = np.sin(freqs), np.cos(freqs)
-    freqs_cis = np.complex64(cos + 1j * sin)
-    return jnp.asarray(freqs_cis)
+class DenseF32Accum(nn.Dense):
+    """Dense layer that multiplies in `dtype` and always accumulates in fp32.
+
+    Gives fp32 accumulation without needing the HIGHEST precision passes, so bf16 kernels
+    and activations keep the numerics of an fp32 matmul at half the bandwidth.
+    """
+
+    @nn.compact
+    def __call__(self, inputs: jnp.ndarray) -> jnp.ndarray:
+        kernel = self.param(
+            'kernel',
+            self.kernel_init,
+            (jnp.shape(inputs)[-1], self.features),
+            self.param_dtype,
+        )
+        inputs = inputs.astype(self.dtype)
+        kernel = kernel.astype(self.dtype)
+        y = lax.dot_general(
+            inputs,
+            kernel,
+            (((inputs.ndim - 1,), (0,)), ((), ())),
+            precision=self.precision,
+            preferred_element_type=jnp.float32,
+        )
+        if self.use_bias:
+            bias = self.param('bias', self.bias_init, (self.features,), self.param_dtype)
+            y = y + jnp.reshape(bias.astype(jnp.float32), (1,) * (y.ndim - 1) + (-1,))
+        return y.astype(self.dtype)
+
+
+@partial(jax.jit, static_argnames=('dim', 'max_position_embedding', 'dtype'))
+def precompute_freqs_cis(dim: int, max_position_embedding: int, theta: float=10000.0, dtype: jnp.dtype=jnp.float32) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    inv_freq = 1.0 / (theta ** (jnp.arange(0, dim, 2, dtype=jnp.float32)[: (dim // 2)] / dim))
+    t = jnp.arange(max_position_embedding, dtype=jnp.float32)
+    freqs = jnp.einsum('i,j->ij', t, inv_freq)
+    return jnp.cos(freqs).astype(dtype), jnp.sin(freqs).astype(dtype)
 
 
 def apply_rotary_emb(
     xq: jnp.ndarray,
     xk: jnp.ndarray,
-    freqs_cis: jnp.ndarray,
+    freqs_cos: jnp.ndarray,
+    freqs_sin: jnp.ndarray,
     dtype: jnp.dtype=jnp.float32,
+    precision: Optional[Union[jax.lax.Precision, str]]=None,
 ) -> Tuple[jnp.ndarray, jnp.ndarray]:
 
-    reshape_xq = xq.astype(jnp.float32).reshape(*xq.shape[:-1], -1, 2)
-    reshape_xk = xk.astype(jnp.float32).reshape(*xk.shape[:-1], -1, 2)
-
-    xq_ = jax.lax.complex(reshape_xq[..., 0], reshape_xq[..., 1])
-    xk_ = jax.lax.complex(reshape_xk[..., 0], reshape_xk[..., 1])
+    # rotate directly in the compute dtype, upcast only when highest precision is requested
+    if precision in ('highest', jax.lax.Precision.HIGHEST):
+        rotate_dtype = jnp.float32
+    else:
+        rotate_dtype = dtype
 
     # add head dim
-    freqs_cis = jnp.reshape(freqs_cis, (*freqs_cis.shape[:2], 1, *freqs_cis.shape[2:]))
-
-    xq_out = xq_ * freqs_cis
-    xq_out = jnp.stack((jnp.real(xq_out), jnp.imag(xq_out)), axis=-1).reshape(*xq_out.shape[:-1], -1)
+    freqs_cos = jnp.expand_dims(freqs_cos, axis=2).astype(rotate_dtype)
+    freqs_sin = jnp.expand_dims(freqs_sin, axis=2).astype(rotate_dtype)
 
-    xk_out = xk_ * freqs_cis
-    xk_out = jnp.stack((jnp.real(xk_out), jnp.imag(xk_out)), axis=-1).reshape(*xk_out.shape[:-1], -1)
+    def rotate(x):
+        x = x.astype(rotate_dtype).reshape(*x.shape[:-1], -1, 2)
+        x0, x1 = x[..., 0], x[..., 1]
+        out = jnp.stack((x0 * freqs_cos - x1 * freqs_sin, x0 * freqs_sin + x1 * freqs_cos), axis=-1)
+        return out.reshape(*out.shape[:-2], -1).astype(dtype)
 
-    return xq_out.astype(dtype), xk_out.astype(dtype)
+    return rotate(xq), rotate(xk)
 
 
 class FlaxLLaMAAttention(nn.Module):
@@ -490,31 +552,16 @@ class FlaxLLaMAAttention(nn.Module):
         self.num_heads = config.num_attention_heads
         self.head_dim = self.embed_dim // self.num_heads
 
-        self.wq = nn.Dense(
-            config.num_attention_heads*self.head_dim,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
-        )
-        self.wk = nn.Dense(
-            config.num_attention_heads*self.head_dim,
+        # wq, wk and wv packed into a single projection, split again in __call__
+        self.wqkv = DenseF32Accum(
+            3*config.num_attention_heads*self.head_dim,
             dtype=self.dtype,
             param_dtype=self.param_dtype,
             use_bias=False,
             kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
             precision=self.precision,
         )
-        self.wv = nn.Dense(
-            config.num_attention_heads*self.head_dim,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
-        )
-        self.wo = nn.Dense(
+        self.wo = DenseF32Accum(
             config.hidden_size,
             dtype=self.dtype,
             param_dtype=self.param_dtype,
@@ -525,13 +572,66 @@ class FlaxLLaMAAttention(nn.Module):
 
         self.resid_dropout = nn.Dropout(rate=config.resid_pdrop)
 
-        self.causal_mask = make_causal_mask(jnp.ones((1, config.max_sequence_length), dtype="bool"), dtype="bool")
+        self._mesh = LLaMAConfig.get_jax_mesh(config.mesh_dim)
+        self._sp = self._mesh.shape['sp']
 
-        self.freqs_cis = precompute_freqs_cis(
-            self.head_dim,
-            config.max_sequence_length,
-            theta=config.theta,
-            dtype=self.dtype,
+        platform = xla_bridge.get_backend().platform
+        if config.use_flash_attention and platform == "tpu":
+            self._ring_attention_fn = ring_flash_attention_tpu
+        else:
+            self._ring_attention_fn = ring_attention # uses BPT attention
+
+        # without attention dropout every blockwise kwarg is static, so the sharded fn is built once
+        self._scan_attn_shard = None
+        if config.attn_pdrop == 0.0:
+            self._scan_attn_shard = self._build_scan_attention(deterministic=True, dropout_rng=None)
+        self._std_attn_shard_q1 = self._build_standard_attention(q_sp_dim=None)
+        self._std_attn_shard_qT = self._build_standard_attention(q_sp_dim='sp')
+
+    @nn.nowrap
+    def _build_scan_attention(self, deterministic, dropout_rng):
+        return shard_map(
+            partial(
+                self._ring_attention_fn,
+                axis_name="sp",
+                float32_logits=True,
+                blockwise_kwargs=dict(
+                    deterministic=deterministic,
+                    dropout_rng=dropout_rng,
+                    attn_pdrop=self.config.attn_pdrop,
+                    causal=True,
+                    query_chunk_size=self.config.scan_query_chunk_size,
+                    key_chunk_size=self.config.scan_key_chunk_size,
+                    dtype=self.dtype,
+                    policy=get_gradient_checkpoint_policy('nothing_saveable'),
+                    precision=self.precision,
+                    prevent_cse=not self.config.scan_layers,
+                )
+            ),
+            mesh=self._mesh,
+            in_specs=(
+                PS(("dp", "fsdp"), "sp", "tp", None),
+                PS(("dp", "fsdp"), "sp", "tp", None),
+                PS(("dp", "fsdp"), "sp", "tp", None),
+                PS(("dp", "fsdp"), None, None, None),
+                PS(("dp", "fsdp"), None),
+            ),
+            out_specs=PS(("dp", "fsdp"), "sp", "tp", None),
+            check_rep=False
+        )
+
+    @nn.nowrap
+    def _build_standard_attention(self, q_sp_dim):
+        return shard_map(
+            partial(ring_attention_standard, axis_name="sp"), mesh=self._mesh,
+            in_specs=(
+                PS(("dp", "fsdp"), q_sp_dim, "tp", None),
+                PS(("dp", "fsdp"), "sp", "tp", None),
+                PS(("dp", "fsdp"), "sp", "tp", None),
+                PS(("dp", "fsdp"), None, q_sp_dim, None)
+            ),
+            out_specs=PS(("dp", "fsdp"), q_sp_dim, "tp", None),
+            check_rep=False
         )
 
     def _split_heads(self, hidden_states):
@@ -549,52 +649,31 @@ class FlaxLLaMAAttention(nn.Module):
         """
         # detect if we're initializing by absence of existing cache data.
         is_initialized = self.has_variable("cache", "cached_key")
-        cached_key = self.variable("cache", "cached_key", jnp.zeros, key.shape, key.dtype)
-        cached_value = self.variable("cache", "cached_value", jnp.zeros, value.shape, value.dtype)
+        # the cache may be stored narrower than the attention dtype, it is widened again on read
+        compute_dtype = key.dtype
+        if self.config.kv_cache_dtype == 'fp8':
+            cache_dtype = jnp.float8_e5m2
+        elif self.config.kv_cache_dtype != '':
+            cache_dtype = get_float_dtype_by_name(self.config.kv_cache_dtype)
+        else:
+            cache_dtype = compute_dtype
+        cached_key = self.variable("cache", "cached_key", jnp.zeros, key.shape, cache_dtype)
+        cached_value = self.variable("cache", "cached_value", jnp.zeros, value.shape, cache_dtype)
         cache_index = self.variable("cache", "cache_index", lambda: jnp.array(0, dtype=jnp.int32))
 
         if is_initialized:
             *batch_dims, max_length, num_heads, depth_per_head = cached_key.value.shape
             # update key, value caches with our new 1d spatial slices
             cur_index = cache_index.value
-            if query.shape[1] == 1:
-                mesh = LLaMAConfig.get_jax_mesh(self.config.mesh_dim)
-                def fn(cached_key, cached_value, key, value, cur_index):
-                    assert key.shape[1] == 1 and value.shape[1] == 1, (key.shape, value.shape)
-                    sp_size = max_length // mesh.shape['sp']
-                    axis_index = jax.lax.axis_index('sp')
-                    cur_index = cur_index - axis_index * sp_size
-                    key, value = jax.lax.cond(
-                        jnp.logical_and(cur_index >= 0, cur_index < sp_size),
-                        lambda: (
-                            cached_key.at[:, cur_index].set(key[:, -1]),
-                            cached_value.at[:, cur_index].set(value[:, -1]),
-                        ),
-                        lambda: (cached_key, cached_value),
-                    )
-                    return key, value
-                fn = shard_map(
-                    fn, mesh=mesh,
-                    in_specs=(
-                        PS(('dp', 'fsdp'), 'sp', 'tp', None), 
-                        PS(('dp', 'fsdp'), 'sp', 'tp', None), 
-                        PS(('dp', 'fsdp'), None, 'tp', None), 
-                        PS(('dp', 'fsdp'), None, 'tp', None),
-                        PS()
-                    ),
-                    out_specs=(
-                        PS(('dp', 'fsdp'), 'sp', 'tp', None),
-                        PS(('dp', 'fsdp'), 'sp', 'tp', None)
-                    ),
-                    check_rep=False
-                )
-                key, value = fn(cached_key.value, cached_value.value, key, value, cur_index)
-            else:
-                indices = (0,) * len(batch_dims) + (cur_index, 0, 0)
-                key = lax.dynamic_update_slice(cached_key.value, key, indices)
-                value = lax.dynamic_update_slice(cached_value.value, value, indices)
+            indices = (0,) * len(batch_dims) + (cur_index, 0, 0)
+            key = lax.dynamic_update_slice(cached_key.value, key.astype(cache_dtype), indices)
+            value = lax.dynamic_update_slice(cached_value.value, value.astype(cache_dtype), indices)
+            # let SPMD partitioning place the update on the owning sp shard
+            key = with_sharding_constraint(key, PS(('dp', 'fsdp'), 'sp', 'tp', None))
+            value = with_sharding_constraint(value, PS(('dp', 'fsdp'), 'sp', 'tp', None))
             cached_key.value = key
             cached_value.value = value
+            key, value = key.astype(compute_dtype), value.astype(compute_dtype)
             num_updated_cache_vectors = query.shape[1]
             cache_index.value = cache_index.value + num_updated_cache_vectors
         return key, value, attention_mask
@@ -609,8 +688,9 @@ class FlaxLLaMAAttention(nn.Module):
         init_cache: bool = False,
         output_attentions: bool = False,
         fcm_mask=None,
+        freqs_cis=None,
     ):
-        xq, xk, xv = self.wq(hidden_states), self.wk(hidden_states), self.wv(hidden_states)
+        xq, xk, xv = jnp.split(self.wqkv(hidden_states), 3, axis=-1)
 
         if xq.shape[1] == 1:
             xq = with_sharding_constraint(xq, PS(("dp", "fsdp"), None, "tp"))
@@ -623,9 +703,21 @@ class FlaxLLaMAAttention(nn.Module):
         xk = self._split_heads(xk)
         xv = self._split_heads(xv)
 
-        freqs_cis = jnp.take(self.freqs_cis, position_ids, axis=0)
+        # (cos, sin) tables shared by all layers, built once in FlaxLLaMABlockCollection
+        freqs_cos, freqs_sin = freqs_cis
+        if self.config.contiguous_position_ids:
+            # positions are start..start+T for every row, a contiguous slice avoids a gather.
+            # Only valid without left padding, FlaxLLaMAForCausalLM.generate rejects padded prompts
+            start, length = position_ids[0, 0], position_ids.shape[-1]
+            freqs_cos = lax.dynamic_slice_in_dim(freqs_cos, start, length, axis=0)[None]
+            freqs_sin = lax.dynamic_slice_in_dim(freqs_sin, start, length, axis=0)[None]
+        else:
+            freqs_cos = jnp.take(freqs_cos, position_ids, axis=0)
+            freqs_sin = jnp.take(freqs_sin, position_ids, axis=0)
 
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis, dtype=self.dtype)
+        xq, xk = apply_rotary_emb(
+            xq, xk, freqs_cos=freqs_cos, freqs_sin=freqs_sin, dtype=self.dtype, precision=self.precision
+        )
 
         dropout_rng = None
         if not deterministic and self.config.attn_pdrop > 0.0:
@@ -646,40 +738,9 @@ class FlaxLLaMAAttention(nn.Module):
             )
             attn_weights = None
 
-            platform = xla_bridge.get_backend().platform
-            if self.config.use_flash_attention and platform == "tpu":
-                ring_attention_fn = ring_flash_attention_tpu
-            else:
-                ring_attention_fn = ring_attention # uses BPT attention
-            ring_attention_sharded = shard_map(
-                partial(
-                    ring_attention_fn,
-                    axis_name="sp",
-                    float32_logits=True,
-                    blockwise_kwargs=dict(
-                        deterministic=deterministic,
-                        dropout_rng=dropout_rng,
-                        attn_pdrop=self.config.attn_pdrop,
-                        causal=True,
-                        query_chunk_size=self.config.scan_query_chunk_size,
-                        key_chunk_size=self.config.scan_key_chunk_size,
-                        dtype=self.dtype,
-                        policy=get_gradient_checkpoint_policy('nothing_saveable'),
-                        precision=self.precision,
-                        prevent_cse=not self.config.scan_layers,
-                    )
-                ),
-                mesh=LLaMAConfig.get_jax_mesh(self.config.mesh_dim),
-                in_specs=(
-                    PS(("dp", "fsdp"), "sp", "tp", None),
-                    PS(("dp", "fsdp"), "sp", "tp", None),
-                    PS(("dp", "fsdp"), "sp", "tp", None),
-                    PS(("dp", "fsdp"), None, None, None),
-                    PS(("dp", "fsdp"), None), 
-                ),
-                out_specs=PS(("dp", "fsdp"), "sp", "tp", None),
-                check_rep=False
-            )
+            ring_attention_sharded = self._scan_attn_shard
+            if ring_attention_sharded is None:
+                ring_attention_sharded = self._build_scan_attention(deterministic, dropout_rng)
             attn_output = ring_attention_sharded(xq, xk, xv, attention_bias, segment_ids)
             attn_output = with_sharding_constraint(attn_output, PS(("dp", "fsdp"), "sp", "tp", None))
         else:
@@ -692,37 +753,44 @@ class FlaxLLaMAAttention(nn.Module):
                 causal_mask = causal_mask[None, None]
                 segment_mask = None
             else:
-                causal_mask = self.causal_mask[:, :, :query_length, :key_length]
+                causal_mask = jnp.arange(key_length)[None] <= jnp.arange(query_length)[:, None]
+                causal_mask = causal_mask[None, None]
                 segment_mask = segment_ids[:, :, None] == segment_ids[:, None, :]
                 segment_mask = segment_mask[:, None]
 
-            batch_size = hidden_states.shape[0]
-            causal_mask = jnp.broadcast_to(causal_mask, (batch_size,) + causal_mask.shape[1:])
+            # fold all masks into one float bias, XLA fuses this into a single elementwise pass.
+            # a select (rather than summing per-mask biases) keeps fully masked rows finite.
+            attention_mask = jnp.logical_and(causal_mask, jnp.expand_dims(attention_mask, axis=(-3, -2)) > 0)
+            if segment_mask is not None:
+                attention_mask = jnp.logical_and(attention_mask, segment_mask)
+            if fcm_mask is not None:
+                fcm_mask = jnp.unpackbits(fcm_mask, axis=-1, count=key_length).astype(bool)
+                attention_mask = jnp.logical_and(attention_mask, fcm_mask)
+            attention_bias = jnp.where(attention_mask, 0.0, jnp.finfo(self.dtype).min).astype(self.dtype)
 
-            attention_mask = jnp.broadcast_to(jnp.expand_dims(attention_mask, axis=(-3, -2)), causal_mask.shape)
-            attention_mask = combine_masks(attention_mask, causal_mask, fcm_mask, segment_mask)
+            batch_size = hidden_states.shape[0]
+            attention_bias = jnp.broadcast_to(attention_bias, (batch_size,) + attention_bias.shape[1:])
 
             # During fast autoregressive decoding, we feed one position at a time,
             # and cache the keys and values step by step.
             if self.has_variable("cache", "cached_key") or init_cache:
-                xk, xv, attention_mask = self._concatenate_to_cache(xk, xv, xq, attention_mask)
+                xk, xv, attention_bias = self._concatenate_to_cache(xk, xv, xq, attention_bias)
 
-            q_sp_dim = None if xq.shape[1] == 1 else 'sp'
             attn_weights = None
-            ring_attention_sharded = shard_map(
-                partial(ring_attention_standard, axis_name="sp"), mesh=LLaMAConfig.get_jax_mesh(self.config.mesh_dim),
-                in_specs=(
-                    PS(("dp", "fsdp"), q_sp_dim, "tp", None),
-                    PS(("dp", "fsdp"), "sp", "tp", None),
-                    PS(("dp", "fsdp"), "sp", "tp", None),
-                    PS(("dp", "fsdp"), None, q_sp_dim, None)
-                ),
-                out_specs=PS(("dp", "fsdp"), q_sp_dim, "tp", None),
-                check_rep=False
-            )
-            attn_output = ring_attention_sharded(
-                xq, xk, xv, attention_mask
-            )
+            if self._sp == 1:
+                # nothing to pass around the ring, let SPMD partition plain attention instead
+                attn_output = standard_attention(
+                    xq, xk, xv, attention_bias, fused=self.config.use_flash_attention
+                )
+                attn_output = with_sharding_constraint(attn_output, PS(("dp", "fsdp"), "sp", "tp", None))
+            else:
+                if xq.shape[1] == 1:
+                    ring_attention_sharded = self._std_attn_shard_q1
+                else:
+                    ring_attention_sharded = self._std_attn_shard_qT
+                attn_output = ring_attention_sharded(
+                    xq, xk, xv, attention_bias
+                )
 
         attn_output = self._merge_heads(attn_output)
         attn_output = self.wo(attn_output)
@@ -730,58 +798,57 @@ class FlaxLLaMAAttention(nn.Module):
         outputs = (attn_output, attn_weights) if output_attentions else (attn_output,)
         return outputs
 
-# TODO: Convert nn calls to flax equivalent
 class S6(nn.Module):
-    def __init__(self, seq_len, d_model, state_size, device):
-        super(S6, self).__init__()
-
-        self.fc1 = nn.Linear(d_model, d_model, device=device)
-        self.fc2 = nn.Linear(d_model, state_size, device=device)
-        self.fc3 = nn.Linear(d_model, state_size, device=device)
-
-        self.seq_len = seq_len
-        self.d_model = d_model
-        self.state_size = state_size
+    d_model: int
+    state_size: int
+    dtype: jnp.dtype=jnp.float32
+    param_dtype: jnp.dtype=jnp.float32
+    precision: Optional[Union[jax.lax.Precision, str]]=None
 
-        #self.A = nn.Parameter(torch.ones(d_model, state_size, device=device))
-        #self.A = nn.Parameter(F.normalize(torch.ones(d_model, state_size, device=device), p=2, dim=-1))
-        #nn.init.xavier_uniform_(self.A)
+    def setup(self) -> None:
+        # Initialize delta's bias by sampling from a uniform distribution and applying the inverse softplus
+        self.fc1 = nn.Dense(
+            self.d_model,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            bias_init=self._delta_bias_init,
+            precision=self.precision,
+        )
+        self.fc2 = nn.Dense(
+            self.state_size,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+        )
+        self.fc3 = nn.Dense(
+            self.state_size,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+        )
 
         # S4D real initialization, MAMBA removed imaginary portions for S4D-Inv and S4D-Lin initialization schemes
         # described in [On the Parameterization and Initialization of Diagonal State Space Models](https://arxiv.org/abs/2206.11893)
         # https://github.com/state-spaces/mamba/blob/fb7b5310fa865dbd62aa059b1e26f2b431363e2a/mamba_ssm/modules/mamba_simple.py#L103-L108C23
-        A = repeat(
-            nn.arange(1, state_size + 1, dtype=nn.float32, device=device),
-            "n -> d n",
-            d=d_model,
-        ).contiguous()
-
-        A_log = nn.log(A)  # For numerical stability during training process
-        self.A_log = nn.Parameter(A_log)
-        self.A_log._no_weight_decay = True
-
-        self.A = nn.zeros_like(self.A_log)
-        self.B = nn.zeros(batch_size, self.seq_len, self.state_size, device=device)
-        self.C = nn.zeros(batch_size, self.seq_len, self.state_size, device=device)
-
-        #self.delta = torch.zeros(batch_size, self.seq_len, self.d_model, device=device)
-        # Initialize delta parameter using a uniform distribution and apply the inverse softplus
-        uniform_distribution = nn.distributions.Uniform(0.001, 0.1)
-        # Sample from the uniform distribution and then apply the inverse softplus
-        self.delta = self.inverse_softplus(uniform_distribution.sample((batch_size, self.seq_len, self.d_model)))
-
-        self.dA = nn.zeros(batch_size, self.seq_len, self.d_model, self.state_size, device=device)
-        self.dB = nn.zeros(batch_size, self.seq_len, self.d_model, self.state_size, device=device)
+        # A_log is kept in fp32 for numerical stability during training process
+        self.A_log = self.param('A_log', self._a_log_init, (self.d_model, self.state_size), jnp.float32)
 
-        # h should have dimensions [batch_size, seq_len, d_model, state_size]
-        self.h = nn.zeros(batch_size, self.seq_len, self.d_model, self.state_size, device=device)
-        self.y = nn.zeros(batch_size, self.seq_len, self.d_model, device=device)
+    @staticmethod
+    def _a_log_init(rng, shape, dtype=jnp.float32):
+        d_model, state_size = shape
+        A = jnp.broadcast_to(jnp.arange(1, state_size + 1, dtype=dtype), (d_model, state_size))
+        return jnp.log(A)
 
+    def _delta_bias_init(self, rng, shape, dtype=jnp.float32):
+        delta = jax.random.uniform(rng, shape, dtype=jnp.float32, minval=0.001, maxval=0.1)
+        return self.inverse_softplus(delta).astype(dtype)
 
-    def inverse_softplus(self, y):
-        return nn.log(nn.exp(y) - 1)
+    @staticmethod
+    def inverse_softplus(y):
+        # log(exp(y) - 1) rewritten to avoid the cancellation in exp(y) - 1 for small y
+        return y + jnp.log(-jnp.expm1(-y))
 
-    def discretization(self):
+    def discretization(self, delta, B):
         # discretization function is defined based on the MAMBA paper's description using ZOH on page 28
         # in Section C : Mechanics on Selective SSMs
         # See also "Zero-order hold discretization" maths proof inside https://studywolf.wordpress.com/tag/zero-order-hold/
@@ -805,89 +872,48 @@ class S6(nn.Module):
         Credit: Claude2 AI chatbot
         """
 
-        # For numerical stability during training process
-        self.A = -nn.exp(self.A_log.float())  # (d_model, state_size)
+        # A is diagonal: each of the d_model channels holds state_size independent eigenvalues,
+        # so exp(A * delta) is a pointwise exp and must not be swapped for a matrix exponential
+        assert self.A_log.shape == (self.d_model, self.state_size), "S6 expects a diagonal A stored as (d_model, state_size)"
 
-        #print(f"self.A.shape = {self.A.shape}")
-        #print(f"self.B.shape = {self.B.shape}")
-        #print(f"self.delta.shape = {self.delta.shape}")
+        # dA and dB are laid out as [batch_size, d_model, state_size, seq_len] so the scan streams
+        # the time axis contiguously
+        delta = jnp.swapaxes(delta, 1, 2)[:, :, None, :]  # [batch_size, d_model, 1, seq_len]
 
-        # inverse() only supports square matrix
-        #dB = torch.matmul(torch.inverse(A * delta), torch.matmul(dA - torch.eye(A.shape[0]), B))
-        self.dB = nn.einsum("bld,bln->bldn", self.delta, self.B)
+        # inverse() only supports square matrix, A is diagonal so ZOH reduces to the elementwise form below
+        dB = delta * jnp.swapaxes(B, 1, 2)[:, None, :, :]
 
         # https://github.com/state-spaces/mamba/blob/0131c1e94a46fc9f70bcfc9d57962963bb2f0b9e/mamba_ssm/modules/mamba_simple.py#L240
-        #dA = torch.matrix_exp(A * delta)  # matrix_exp() only supports square matrix
-        self.dA = nn.exp(nn.einsum("bld,dn->bldn", self.delta, self.A))
-        #print(f"self.dA.shape = {self.dA.shape}")
-        #print(f"self.dA.requires_grad = {self.dA.requires_grad}")
+        # A = -exp(A_log) for numerical stability, the negation is folded into the same pointwise expression
+        dA = jnp.exp(-delta * jnp.exp(self.A_log)[..., None])
 
-        return self.dA, self.dB
+        return dA, dB
 
-    def forward(self, x):
+    def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
         # Refer to Algorithm 2 in the MAMBA paper
-        self.B = self.fc2(x)
-        self.C = self.fc3(x)
+        B = self.fc2(x)
+        C = self.fc3(x)
 
         # "a large ∆ resets the state `h` and focuses on the current input `x`,
         # while a small ∆ persists the state and ignores the current input."
-        self.delta = F.softplus(self.fc1(x))
+        delta = nn.softplus(self.fc1(x))
 
         # Uses ZOH as in MAMBA, Hungry Hippo still uses bilinear transform for discretization
-        self.discretization()
-
-        if DIFFERENT_H_STATES_RECURRENT_UPDATE_MECHANISM:  # this will trigger in-place runtime error if without using `h_new`
-            #print(f"self.dA = {self.dA}, self.dB = {self.dB}")
-            #print(f"self.dA.shape = {self.dA.shape}")
-            #print(f"self.dB.shape = {self.dB.shape}")
-            #print(f"x.shape = {x.shape}")
-            #print(f"self.h.shape = {self.h.shape}")
-            #print(f"self.C.shape = {self.C.shape}")
-
-            global current_batch_size
-            current_batch_size = x.shape[0]
-
-            if self.h.shape[0] != current_batch_size:
-                #print("Adjusting h_new for the different batch size of input data `x`")
-                different_batch_size = True
-
-                # Resize self.h to match the current batch size
-                h_new =  nn.einsum('bldn,bldn->bldn', self.dA, self.h[:current_batch_size, ...]) + rearrange(x, "b l d -> b l d 1") * self.dB
-
-            else:
-                different_batch_size = False
-                h_new =  nn.einsum('bldn,bldn->bldn', self.dA, self.h) + rearrange(x, "b l d -> b l d 1") * self.dB
-
-            # y needs to have a shape of [batch_size, seq_len, d_model]
-            self.y = nn.einsum('bln,bldn->bld', self.C, h_new)
-
-            # Update self.h with the detached state of h_new
-            # Only do this if retaining gradients for self.h is not necessary for backprop
-            # Otherwise, store h_new in a temporary list and update self.h after the loop
-            global temp_buffer
-            temp_buffer = h_new.detach().clone() if not self.h.requires_grad else h_new.clone()
-            #print(f"temp_buffer.shape = {temp_buffer.shape}")
-
-            #print(f"self.y = {self.y}")
-            #print(f"self.dA.requires_grad = {self.dA.requires_grad}")
-            #print(f"self.dB.requires_grad = {self.dB.requires_grad}")
-            #print(f"self.C.requires_grad = {self.C.requires_grad}")
-            #print(f"self.h.requires_grad = {self.h.requires_grad}")
-            #print(f"self.y.requires_grad = {self.y.requires_grad}")
-
-            return self.y
+        dA, dB = self.discretization(delta, B)
 
-        else:  # this will not trigger in-place runtime error
-            # h should have dimensions [batch_size, seq_len, d_model, state_size]
-            h = nn.zeros(x.size(0), self.seq_len, self.d_model, self.state_size, device=x.device)
-            y = nn.zeros_like(x)
+        # h_t = dA_t * h_{t-1} + dB_t * x_t over the sequence axis, solved with a parallel scan
+        # h should have dimensions [batch_size, d_model, state_size, seq_len]
+        def combine(left, right):
+            a_l, b_l = left
+            a_r, b_r = right
+            return a_r * a_l, a_r * b_l + b_r
 
-            h =  nn.einsum('bldn,bldn->bldn', self.dA, h) + rearrange(x, "b l d -> b l d 1") * self.dB
+        _, h = jax.lax.associative_scan(combine, (dA, jnp.swapaxes(x, 1, 2)[:, :, None, :] * dB), axis=-1)
 
-            # y needs to have a shape of [batch_size, seq_len, d_model]
-            y = nn.einsum('bln,bldn->bld', self.C, h)
+        # y needs to have a shape of [batch_size, seq_len, d_model]
+        y = jnp.einsum('bln,bdnl->bld', C, h)
 
-            return y
+        return y.astype(self.dtype)
 
 class FlaxLLaMAMLP(nn.Module):
     config: LLaMAConfig
@@ -897,8 +923,9 @@ class FlaxLLaMAMLP(nn.Module):
 
     def setup(self) -> None:
         config = self.config
-        self.w1 = nn.Dense(
-            config.intermediate_size,
+        # w1 (gate) and w3 (up) packed into a single projection, split again in __call__
+        self.w13 = nn.Dense(
+            2*config.intermediate_size,
             dtype=self.dtype,
             param_dtype=self.param_dtype,
             use_bias=False,
@@ -913,98 +940,106 @@ class FlaxLLaMAMLP(nn.Module):
             kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
             precision=self.precision,
         )
-        self.w3 = nn.Dense(
-            config.intermediate_size,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
-        )
         self.dropout = nn.Dropout(rate=self.config.resid_pdrop)
 
     def __call__(self, x: jnp.ndarray, deterministic: bool = True) -> jnp.ndarray:
-        x = self.w2(nn.silu(self.w1(x)) * self.w3(x))
+        gate, up = jnp.split(self.w13(x), 2, axis=-1)
+        x = self.w2(nn.silu(gate) * up)
         x = self.dropout(x, deterministic=deterministic)
         return x
 
 class MambaBlock(nn.Module):
-    def __init__(self, seq_len, d_model, state_size, device):
-        super(MambaBlock, self).__init__()
+    d_model: int
+    state_size: int
+    eps: float=1e-6
+    scan_layers: bool=False
+    dtype: jnp.dtype=jnp.float32
+    param_dtype: jnp.dtype=jnp.float32
+    precision: Optional[Union[jax.lax.Precision, str]]=None
 
-        self.inp_proj = nn.Linear(d_model, 2*d_model, device=device)
-        self.out_proj = nn.Linear(2*d_model, d_model, device=device)
+    def setup(self) -> None:
+        self.inp_proj = nn.Dense(
+            2*self.d_model,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+        )
+        # Initialize bias to a small constant value
+        self.out_proj = nn.Dense(
+            self.d_model,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            bias_init=nn.initializers.constant(1.0),
+            precision=self.precision,
+        )
 
         # For residual skip connection
-        self.D = nn.Linear(d_model, 2*d_model, device=device)
-
-        # Set _no_weight_decay attribute on bias
-        self.out_proj.bias._no_weight_decay = True
-
-        # Initialize bias to a small constant value
-        nn.init.constant_(self.out_proj.bias, 1.0)
+        self.D = nn.Dense(
+            2*self.d_model,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+        )
 
-        self.S6 = S6(seq_len, 2*d_model, state_size, device)
+        self.S6 = S6(
+            2*self.d_model,
+            self.state_size,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+        )
 
-        # Add 1D convolution with kernel size 3
-        self.conv = nn.Conv1d(seq_len, seq_len, kernel_size=3, padding=1, device=device)
+        # Add depthwise 1D convolution with kernel size 3 along the sequence axis,
+        # causal padding pads the left side only
+        self.conv = nn.Conv(
+            2*self.d_model,
+            kernel_size=(3,),
+            padding='CAUSAL',
+            feature_group_count=2*self.d_model,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+        )
 
         # rmsnorm
-        self.norm = RMSNorm(d_model, device=device)
-
+        self.norm = RMSNorm(self.d_model, eps=self.eps, dtype=self.dtype, param_dtype=self.param_dtype)
 
-    def forward(self, x, attention_mask=None):
+    def __call__(self, x: jnp.ndarray, attention_mask: Optional[jnp.ndarray]=None) -> jnp.ndarray:
 
         if attention_mask is not None:
             # Apply the attention mask
-            x = x * attention_mask.unsqueeze(-1)
+            x = x * jnp.expand_dims(attention_mask, -1).astype(x.dtype)
 
         """
-        x_proj.shape = torch.Size([batch_size, seq_len, 2*d_model])
-        x_conv.shape = torch.Size([batch_size, seq_len, 2*d_model])
-        x_conv_act.shape = torch.Size([batch_size, seq_len, 2*d_model])
+        x_proj.shape = [batch_size, seq_len, 2*d_model]
+        x_conv.shape = [batch_size, seq_len, 2*d_model]
+        x_conv_act.shape = [batch_size, seq_len, 2*d_model]
         """
         # Refer to Figure 3 in the MAMBA paper
 
         x = self.norm(x)
 
         x_proj = self.inp_proj(x)
-        #print(f"x_proj.shape = {x_proj.shape}")
 
-        # Add 1D convolution with kernel size 3
+        # Add 1D convolution with kernel size 3, flax convolves over the sequence axis with channels last
+        # Causal padding keeps every output position from seeing later ones, so no mask is needed
         x_conv = self.conv(x_proj)
 
-        # Create a triangular mask of the same shape as the input sequence
-        mask = nn.tril(nn.ones(seq_len, 2*d_model, device=device))
-
-        # Add batch dimension with unsqueeze(0) -> (1, seq_len, seq_len)
-        # Repeat batch dim to match x_conv batches with .repeat()
-        current_batch_size = x.shape[0]
-        mask = mask.repeat(current_batch_size, 1, 1)
-
-        # Apply causal mask to zero out the masked regions
-        x_conv = x_conv * mask
-        #print(f"x_conv.shape = {x_conv.shape}")
-
-        x_conv_act = F.silu(x_conv)  # Swish activation can be implemented as x * sigmoid(x)
-        #print(f"x_conv_act.shape = {x_conv_act.shape}")
+        x_conv_act = nn.silu(x_conv)  # Swish activation can be implemented as x * sigmoid(x)
 
         x_ssm = self.S6(x_conv_act)
-        #print(f"x_ssm.shape = {x_ssm.shape}")
 
         # residual skip connection with nonlinearity introduced by multiplication
-        x_residual = F.silu(self.D(x))
-        #print(f"x_residual.shape = {x_residual.shape}")
+        x_residual = nn.silu(self.D(x))
         x_combined = x_ssm * x_residual
-        #print(f"x_combined.shape = {x_combined.shape}")
 
         x_out = self.out_proj(x_combined)
-        #print(f"x_out.shape = {x_out.shape}")
 
+        if self.scan_layers:
+            return x_out, None
         return x_out
 
 
-
 class FlaxLLaMABlock(nn.Module):
     config: LLaMAConfig
     dtype: jnp.dtype=jnp.float32
@@ -1014,6 +1049,12 @@ class FlaxLLaMABlock(nn.Module):
     def setup(self) -> None:
         attention_module = FlaxLLaMAAttention
         mlp_module = FlaxLLaMAMLP
+        # norms are cheap to recompute, never keep their activations for backward
+        norm_module = remat(
+            RMSNorm,
+            policy=get_gradient_checkpoint_policy('nothing_saveable'),
+            prevent_cse=not self.config.scan_layers,
+        )
         if self.config.remat_attention != '':
             attention_module = remat(
                 FlaxLLaMAAttention, static_argnums=(4, 5, 6),
@@ -1027,25 +1068,33 @@ class FlaxLLaMABlock(nn.Module):
                 prevent_cse=not self.config.scan_layers,
             )
 
+        # projection kernels are stored in config.param_dtype, norms keep self.param_dtype
+        dense_dtype = self.dtype
+        if self.config.compute_dtype != '':
+            dense_dtype = get_float_dtype_by_name(self.config.compute_dtype)
+        dense_param_dtype = self.param_dtype
+        if self.config.param_dtype != '':
+            dense_param_dtype = get_float_dtype_by_name(self.config.param_dtype)
+
         self.attention = attention_module(
             self.config,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
+            dtype=dense_dtype,
+            param_dtype=dense_param_dtype,
             precision=self.precision,
         )
         self.feed_forward = mlp_module(
             self.config,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
+            dtype=dense_dtype,
+            param_dtype=dense_param_dtype,
             precision=self.precision,
         )
-        self.attention_norm = RMSNorm(
+        self.attention_norm = norm_module(
             self.config.hidden_size,
             eps=self.config.rms_norm_eps,
             dtype=self.dtype,
             param_dtype=self.param_dtype,
         )
-        self.ffn_norm = RMSNorm(
+        self.ffn_norm = norm_module(
             self.config.hidden_size,
             eps=self.config.rms_norm_eps,
             dtype=self.dtype,
@@ -1063,6 +1112,7 @@ class FlaxLLaMABlock(nn.Module):
         init_cache: bool = False,
         output_attentions: bool = False,
         fcm_mask: Optional[jnp.ndarray] = None,
+        freqs_cis: Optional[Tuple[jnp.ndarray, jnp.ndarray]] = None,
     ):
         attn_outputs = self.attention(
             self.attention_norm(hidden_states),
@@ -1073,6 +1123,7 @@ class FlaxLLaMABlock(nn.Module):
             init_cache,
             output_attentions,
             fcm_mask,
+            freqs_cis,
         )
         attn_output = attn_outputs[0]
         hidden_states = hidden_states + attn_output
@@ -1102,6 +1153,76 @@ class FlaxLLaMABlock(nn.Module):
         return outputs
 
 
+class FlaxLLaMABlockGroup(nn.Module):
+    """ num_hidden_layers // scan_checkpoint_groups blocks applied back to back.
+        Scanned under remat so only the group inputs are saved for backward.
+    """
+    config: LLaMAConfig
+    dtype: jnp.dtype=jnp.float32
+    param_dtype: jnp.dtype=jnp.float32
+    precision: Optional[Union[jax.lax.Precision, str]]=None
+
+    @nn.compact
+    def __call__(
+        self,
+        hidden_states,
+        attention_mask=None,
+        segment_ids=None,
+        position_ids=None,
+        deterministic: bool = True,
+        init_cache: bool = False,
+        output_attentions: bool = False,
+        fcm_mask: Optional[jnp.ndarray] = None,
+        freqs_cis: Optional[Tuple[jnp.ndarray, jnp.ndarray]] = None,
+    ):
+        num_layers = self.config.num_hidden_layers // self.config.scan_checkpoint_groups
+        for i in range(num_layers):
+            hidden_states, _ = FlaxLLaMABlock(
+                self.config,
+                name=str(i),
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
+                precision=self.precision,
+            )(
+                hidden_states,
+                attention_mask,
+                segment_ids,
+                position_ids,
+                deterministic,
+                init_cache,
+                output_attentions,
+                fcm_mask,
+                freqs_cis,
+            )
+        return hidden_states, None
+
+
+# packed projection -> the separately saved kernels it concatenates on the output axis
+PACKED_PROJECTIONS = (
+    ('wqkv', ('wq', 'wk', 'wv')),
+    ('w13', ('w1', 'w3')),
+)
+
+
+def fuse_projection_params(params):
+    """ Convert params saved with separate wq/wk/wv attention kernels and
+        w1/w3 feed forward kernels into the packed wqkv and w13 layouts.
+        Params that are already packed are returned as is. Checkpoint loaders
+        call this on the restored params before matching partition rules.
+    """
+    frozen = isinstance(params, FrozenDict)
+    params = flatten_dict(unfreeze(params))
+    for packed, names in PACKED_PROJECTIONS:
+        for key in [k for k in params.keys() if k[-2:] == (names[0], 'kernel')]:
+            prefix = key[:-2]
+            params[prefix + (packed, 'kernel')] = jnp.concatenate(
+                [params.pop(prefix + (name, 'kernel')) for name in names],
+                axis=-1,
+            )
+    params = unflatten_dict(params)
+    return freeze(params) if frozen else params
+
+
 class FlaxLLaMAPreTrainedModel(FlaxPreTrainedModel):
     """
     An abstract class to handle weights initialization and a simple interface for downloading and loading pretrained
@@ -1153,7 +1274,7 @@ class FlaxLLaMAPreTrainedModel(FlaxPreTrainedModel):
 
         if params is not None:
             random_params = flatten_dict(unfreeze(random_params))
-            params = flatten_dict(unfreeze(params))
+            params = flatten_dict(unfreeze(fuse_projection_params(params)))
             for missing_key in self._missing_keys:
                 params[missing_key] = random_params[missing_key]
             self._missing_keys = set()
@@ -1176,10 +1297,14 @@ class FlaxLLaMAPreTrainedModel(FlaxPreTrainedModel):
         segment_ids = jnp.zeros_like(input_ids)
         position_ids = jnp.broadcast_to(jnp.arange(jnp.atleast_2d(input_ids).shape[-1]), input_ids.shape)
 
-        init_variables = self.module.init(
-            jax.random.PRNGKey(0), input_ids, attention_mask, segment_ids, position_ids, return_dict=False, init_cache=True
+        # only the cache shapes are needed, so trace init abstractly instead of running it and
+        # materializing a throwaway copy of the params, then allocate the zeroed cache directly
+        init_variables = jax.eval_shape(
+            partial(self.module.init, return_dict=False, init_cache=True),
+            jax.random.PRNGKey(0), input_ids, attention_mask, segment_ids, position_ids
         )
-        return init_variables["cache"].unfreeze()
+        cache = jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), init_variables["cache"])
+        return cache.unfreeze()
 
     @add_start_docstrings_to_model_forward("")
     def __call__(
@@ -1208,12 +1333,12 @@ class FlaxLLaMAPreTrainedModel(FlaxPreTrainedModel):
             if past_key_values is not None:
                 raise ValueError("Make sure to provide `position_ids` when passing `past_key_values`.")
 
-            position_ids = jnp.broadcast_to(jnp.arange(sequence_length)[None, :], (batch_size, sequence_length))
+            position_ids = jnp.broadcast_to(jnp.arange(sequence_length, dtype="i4")[None, :], (batch_size, sequence_length))
 
         if attention_mask is None:
-            attention_mask = jnp.ones((batch_size, sequence_length))
+            attention_mask = jnp.ones((batch_size, sequence_length), dtype="i4")
         if segment_ids is None:
-            segment_ids = jnp.zeros((batch_size, sequence_length))
+            segment_ids = jnp.zeros((batch_size, sequence_length), dtype="i4")
 
         # Handle any PRNG if needed
         rngs = {}
@@ -1231,10 +1356,10 @@ class FlaxLLaMAPreTrainedModel(FlaxPreTrainedModel):
 
         outputs = self.module.apply(
             inputs,
-            jnp.array(input_ids, dtype="i4"),
-            jnp.array(attention_mask, dtype="i4"),
-            jnp.array(segment_ids, dtype="i4"),
-            jnp.array(position_ids, dtype="i4"),
+            jnp.asarray(input_ids, dtype="i4"),
+            jnp.asarray(attention_mask, dtype="i4"),
+            jnp.asarray(segment_ids, dtype="i4"),
+            jnp.asarray(position_ids, dtype="i4"),
             not train,
             False,
             output_attentions,
@@ -1286,15 +1411,23 @@ class FlaxLLaMABlockCollection(nn.Module):
                 minval=self.config.fcm_min_ratio,
                 maxval=self.config.fcm_max_ratio
             )
-            fcm_mask = jax.random.uniform(
-                self.make_rng('fcm'),
+            fcm_mask = jax.random.bernoulli(
+                self.make_rng('fcm'), p=1.0 - fcm_ratio,
                 shape=(batch_size, 1, seq_length, seq_length)
-            ) > fcm_ratio
+            )
             fcm_mask = fcm_mask.at[:, :, :, 0].set(True)
-            fcm_mask = fcm_mask.astype('bool')
+            # carried through every layer packed eight keys per byte, unpacked in attention
+            fcm_mask = jnp.packbits(fcm_mask, axis=-1)
         else:
             fcm_mask = None
 
+        freqs_cis = precompute_freqs_cis(
+            self.config.hidden_size // self.config.num_attention_heads,
+            self.config.max_sequence_length,
+            theta=self.config.theta,
+            dtype=self.dtype,
+        )
+
         block = FlaxLLaMABlock
         if self.config.remat_block != '':
             block = remat(
@@ -1303,11 +1436,30 @@ class FlaxLLaMABlockCollection(nn.Module):
                 policy=get_gradient_checkpoint_policy(self.config.remat_block)
             )
         if self.config.scan_layers:
+            if self.config.remat_block == '' and self.config.scan_remat_block != '':
+                # checkpoint the scanned body so backward only keeps the per-layer carry
+                block = remat(
+                    FlaxLLaMABlock, static_argnums=(4, 5, 6),
+                    prevent_cse=False,
+                    policy=get_gradient_checkpoint_policy(self.config.scan_remat_block)
+                )
             initializing = self.is_mutable_collection('params')
             params_spec = (
                 self.config.param_scan_axis if initializing else
                 nn_partitioning.ScanIn(self.config.param_scan_axis))
             cache_spec = 0
+            scan_length = self.config.num_hidden_layers
+            if self.config.scan_checkpoint_groups > 0:
+                # remat_scan: scan over sqrt(L) checkpointed groups of sqrt(L) layers,
+                # activation memory becomes O(sqrt(L)) instead of O(L)
+                assert self.config.num_hidden_layers % self.config.scan_checkpoint_groups == 0, \
+                    'num_hidden_layers must be divisible by scan_checkpoint_groups'
+                block = remat(
+                    FlaxLLaMABlockGroup, static_argnums=(4, 5, 6),
+                    prevent_cse=False,
+                    policy=get_gradient_checkpoint_policy(self.config.remat_block or 'nothing_saveable')
+                )
+                scan_length = self.config.scan_checkpoint_groups
             hidden_states, _ = nn.scan(
                 block,
                 variable_axes={
@@ -1319,8 +1471,8 @@ class FlaxLLaMABlockCollection(nn.Module):
                     'params': True,
                     'dropout': True
                 },
-                in_axes=(nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast),
-                length=self.config.num_hidden_layers,
+                in_axes=(nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast),
+                length=scan_length,
                 metadata_params={nn.PARTITION_NAME: 'scan_decoder_layer'},
                 )(self.config, name='scan_decoder', dtype=self.dtype, param_dtype=self.param_dtype,)(
                     hidden_states,
@@ -1331,6 +1483,7 @@ class FlaxLLaMABlockCollection(nn.Module):
                     init_cache,
                     output_attentions,
                     fcm_mask,
+                    freqs_cis,
                 )
         else:
             blocks = [
@@ -1354,6 +1507,7 @@ class FlaxLLaMABlockCollection(nn.Module):
                     init_cache,
                     output_attentions,
                     fcm_mask,
+                    freqs_cis,
                 )
                 hidden_states = layer_outputs
 
@@ -1385,10 +1539,28 @@ class FlaxLLaMAModule(nn.Module):
         self.dropout = nn.Dropout(rate=self.config.embd_pdrop)
         self.h = FlaxLLaMABlockCollection(self.config, dtype=self.dtype, param_dtype=self.param_dtype, precision=self.precision)
         
-        self.m1 = MambaBlock(self.config.max_sequence_length, self.config.hidden_size, self.config.scan_mlp_chunk_size, "cuda")
-        self.m2 = MambaBlock(self.config.max_sequence_length, self.config.hidden_size, self.config.scan_mlp_chunk_size, "cuda")
-        self.m3 = MambaBlock(self.config.max_sequence_length, self.config.hidden_size, self.config.scan_mlp_chunk_size, "cuda")
-        self.final_proj = nn.Linear(self.config.hidden_size, self.config.hidden_size, device=device)
+        if USE_MAMBA:
+            # three Mamba blocks with stacked params, traced once
+            self.mamba_blocks = nn.scan(
+                MambaBlock,
+                variable_axes={'params': 0},
+                split_rngs={'params': True},
+                length=3,
+            )(
+                self.config.hidden_size,
+                self.config.mamba_state_size,
+                eps=self.config.rms_norm_eps,
+                scan_layers=True,
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
+                precision=self.precision,
+            )
+            self.final_proj = nn.Dense(
+                self.config.hidden_size,
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
+                precision=self.precision,
+            )
 
         self.ln_f = RMSNorm(self.config.hidden_size, eps=self.config.rms_norm_eps, dtype=self.dtype, param_dtype=self.param_dtype)
 
@@ -1422,12 +1594,11 @@ class FlaxLLaMAModule(nn.Module):
 
         hidden_states = outputs[0]
         
-        # Mamba blocks
-        hidden_states = self.m1(hidden_states)
-        hidden_states = self.m2(hidden_states)
-        hidden_states = self.m3(hidden_states)
-        
-        hidden_states = self.final_proj(hidden_states)
+        if USE_MAMBA:
+            # Mamba blocks
+            hidden_states, _ = self.mamba_blocks(hidden_states)
+
+            hidden_states = self.final_proj(hidden_states)
         
         hidden_states = self.ln_f(hidden_states)
 
@@ -1446,6 +1617,13 @@ class FlaxLLaMAModule(nn.Module):
             attentions=outputs[-1],
         )
 
+def tied_embedding_logits(hidden_states, embedding, dtype, precision=None):
+    # contract against the [vocab, hidden] embedding in its stored layout, rather than applying the
+    # head to a transposed copy of it, so XLA emits one GEMM with no extra pass over the table
+    hidden_states, embedding = hidden_states.astype(dtype), embedding.astype(dtype)
+    return jnp.einsum('...d,vd->...v', hidden_states, embedding, precision=precision)
+
+
 @add_start_docstrings("", "")
 class FlaxLLaMAModel(FlaxLLaMAPreTrainedModel):
     module_class = FlaxLLaMAModule
@@ -1480,15 +1658,18 @@ class FlaxLLaMAForCausalLMModule(nn.Module):
         return_dict: bool = True,
     ):
         batch_size, seq_length = input_ids.shape
+        if position_ids is None:
+            # computed once here and threaded to every layer; without a mask the
+            # cumsum is just an arange, so skip it on the default training path
+            if attention_mask is None:
+                position_ids = jnp.arange(seq_length, dtype=jnp.int32)[None, :]
+            else:
+                position_ids = jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0)
+            position_ids = jnp.broadcast_to(position_ids, (batch_size, seq_length))
         if attention_mask is None:
             attention_mask = jnp.ones_like(input_ids)
         if segment_ids is None:
             segment_ids = jnp.zeros_like(input_ids)
-        if position_ids is None:
-            position_ids = jnp.broadcast_to(
-                jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0),
-                (batch_size, seq_length)
-            )
         outputs = self.transmamba(
             input_ids,
             attention_mask,
@@ -1504,8 +1685,9 @@ class FlaxLLaMAForCausalLMModule(nn.Module):
         hidden_states = outputs[0]
 
         if self.config.tie_word_embeddings:
-            shared_kernel = self.transmamba.variables["params"]["wte"]["embedding"].T
-            lm_logits = self.lm_head.apply({"params": {"kernel": shared_kernel}}, hidden_states)
+            lm_logits = tied_embedding_logits(
+                hidden_states, self.transmamba.variables["params"]["wte"]["embedding"], self.dtype, self.precision
+            )
         else:
             lm_logits = self.lm_head(hidden_states)
 
@@ -1515,6 +1697,24 @@ class FlaxLLaMAForCausalLMModule(nn.Module):
         return FlaxCausalLMOutput(logits=lm_logits, hidden_states=outputs.hidden_states, attentions=outputs.attentions)
 
 
+# Prompts are left padded up to one of these lengths so generation compiles once per bucket
+# rather than once per prompt length, with the attention masks folded into the HLO as constants.
+GENERATION_LENGTH_BUCKETS = (1, 64, 128, 256, 512, 1024, 2048)
+
+
+@partial(jax.jit, static_argnames=('max_length',))
+def build_generation_inputs(input_ids, attention_mask, max_length):
+    # jitted so repeated generate calls with the same shapes reuse one executable instead of dispatching op by op
+    batch_size, seq_length = input_ids.shape
+    extended_attention_mask = jnp.ones((batch_size, max_length), dtype="i4")
+    if attention_mask is not None:
+        position_ids = attention_mask.cumsum(axis=-1) - 1
+        extended_attention_mask = lax.dynamic_update_slice(extended_attention_mask, attention_mask.astype("i4"), (0, 0))
+    else:
+        position_ids = jnp.broadcast_to(jnp.arange(seq_length, dtype="i4")[None, :], (batch_size, seq_length))
+    return extended_attention_mask, position_ids
+
+
 @add_start_docstrings("", "")
 class FlaxLLaMAForCausalLM(FlaxLLaMAPreTrainedModel):
     module_class = FlaxLLaMAForCausalLMModule
@@ -1530,12 +1730,7 @@ class FlaxLLaMAForCausalLM(FlaxLLaMAPreTrainedModel):
         # Note that usually one would have to put 0's in the attention_mask for x > input_ids.shape[-1] and x < cache_length.
         # But since GPTJ uses a causal mask, those positions are masked anyways.
         # Thus we can create a single static attention_mask here, which is more efficient for compilation
-        extended_attention_mask = jnp.ones((batch_size, max_length), dtype="i4")
-        if attention_mask is not None:
-            position_ids = attention_mask.cumsum(axis=-1) - 1
-            extended_attention_mask = lax.dynamic_update_slice(extended_attention_mask, attention_mask, (0, 0))
-        else:
-            position_ids = jnp.broadcast_to(jnp.arange(seq_length, dtype="i4")[None, :], (batch_size, seq_length))
+        extended_attention_mask, position_ids = build_generation_inputs(input_ids, attention_mask, max_length)
 
         return {
             "past_key_values": past_key_values,
@@ -1548,6 +1743,45 @@ class FlaxLLaMAForCausalLM(FlaxLLaMAPreTrainedModel):
         model_kwargs["position_ids"] = model_kwargs["position_ids"][:, -1:] + 1
         return model_kwargs
 
+    def generate(self, input_ids, attention_mask: Optional[jax.Array] = None, **kwargs):
+        if self.config.contiguous_position_ids:
+            # RoPE reads every row's positions from row 0, which only holds for unpadded prompts,
+            # so the prompt is neither bucket padded nor allowed to carry padding of its own
+            if attention_mask is not None and (
+                isinstance(attention_mask, jax.core.Tracer) or not bool(jnp.all(attention_mask))
+            ):
+                raise ValueError(
+                    "contiguous_position_ids requires unpadded prompts, pass attention_mask=None "
+                    "or disable contiguous_position_ids"
+                )
+            return super().generate(input_ids, attention_mask=attention_mask, **kwargs)
+
+        batch_size, seq_length = input_ids.shape
+        bucket_length = next((b for b in GENERATION_LENGTH_BUCKETS if b >= seq_length), seq_length)
+        n_pad = bucket_length - seq_length
+        if n_pad == 0:
+            return super().generate(input_ids, attention_mask=attention_mask, **kwargs)
+
+        # padded positions are masked out, their position ids come from the attention mask cumsum
+        if attention_mask is None:
+            attention_mask = jnp.ones_like(input_ids)
+        pad_token_id = self.config.pad_token_id if self.config.pad_token_id is not None else 0
+        input_ids = jnp.pad(input_ids, ((0, 0), (n_pad, 0)), constant_values=pad_token_id)
+        attention_mask = jnp.pad(attention_mask, ((0, 0), (n_pad, 0)))
+
+        # max_length counts the prompt, shift it past the padding wherever it comes from so the
+        # padding does not eat into the generation budget. max_new_tokens is already relative.
+        generation_config = kwargs.get("generation_config")
+        if generation_config is None:
+            generation_config = self.generation_config
+        max_new_tokens = kwargs.get("max_new_tokens", generation_config.max_new_tokens)
+        max_length = kwargs.get("max_length", generation_config.max_length)
+        if max_new_tokens is None and max_length is not None:
+            kwargs["max_length"] = max_length + n_pad
+
+        outputs = super().generate(input_ids, attention_mask=attention_mask, **kwargs)
+        return outputs.replace(sequences=outputs.sequences[:, n_pad:])
+
 
 VOCAB_FILES_NAMES = {"vocab_file": "tokenizer.model"}
 
@@ -1565,6 +1799,12 @@ class LLaMATokenizer(PreTrainedTokenizer):
     vocab_files_names = VOCAB_FILES_NAMES
     pretrained_vocab_files_map = PRETRAINED_VOCAB_FILES_MAP
     model_input_names = ["input_ids", "attention_mask"]
+    # keyword arguments of `_batch_encode_plus` that `_batch_prepare_for_model` accepts
+    _BATCH_PREPARE_ARGS = (
+        "add_special_tokens", "padding_strategy", "truncation_strategy", "max_length", "stride",
+        "pad_to_multiple_of", "return_tensors", "return_token_type_ids", "return_attention_mask",
+        "return_overflowing_tokens", "return_special_tokens_mask", "return_length", "verbose",
+    )
 
     def __init__(
         self,
@@ -1584,12 +1824,8 @@ class LLaMATokenizer(PreTrainedTokenizer):
         self.add_eos_token = add_eos_token
         self.sp_model = spm.SentencePieceProcessor(**self.sp_model_kwargs)
 
-        with tempfile.NamedTemporaryFile() as tfile:
-            with open_file(self.vocab_file, 'rb') as fin:
-                tfile.write(fin.read())
-                tfile.flush()
-                tfile.seek(0)
-            self.sp_model.Load(tfile.name)
+        with open_file(self.vocab_file, 'rb') as fin:
+            self.sp_model.LoadFromSerializedProto(fin.read())
         """ Initialisation"""
         self.add_special_tokens(dict(
             unk_token=unk_token,
@@ -1613,7 +1849,11 @@ class LLaMATokenizer(PreTrainedTokenizer):
 
     def get_vocab(self):
         """Returns vocab as a dict"""
-        vocab = {self.convert_ids_to_tokens(i): i for i in range(self.vocab_size)}
+        # the sentencepiece vocab is fixed once loaded, look its pieces up in one batch call and keep them
+        if getattr(self, "_vocab_cache", None) is None:
+            ids = list(range(self.vocab_size))
+            self._vocab_cache = dict(zip(self.sp_model.IdToPiece(ids), ids))
+        vocab = dict(self._vocab_cache)
         vocab.update(self.added_tokens_encoder)
         return vocab
 
@@ -1621,6 +1861,25 @@ class LLaMATokenizer(PreTrainedTokenizer):
         """Returns a tokenized string."""
         return self.sp_model.encode(text, out_type=str)
 
+    def _batch_encode_plus(self, batch_text_or_text_pairs, **kwargs):
+        """
+        Encodes a batch of plain strings with one sentencepiece batch call straight to ids, instead of tokenizing
+        each string to pieces and looking the pieces up one by one. Pairs, pretokenized inputs and texts containing
+        added or special tokens take the generic path, which splits those tokens out first.
+        """
+        no_split_tokens = self.unique_no_split_tokens
+        if (
+            kwargs.get("is_split_into_words", False)
+            or kwargs.get("return_offsets_mapping", False)
+            or not all(isinstance(text, str) for text in batch_text_or_text_pairs)
+            or any(token in text for text in batch_text_or_text_pairs for token in no_split_tokens)
+        ):
+            return super()._batch_encode_plus(batch_text_or_text_pairs, **kwargs)
+
+        batch_ids = self.sp_model.encode(list(batch_text_or_text_pairs), out_type=int)
+        prepare_kwargs = {k: v for k, v in kwargs.items() if k in self._BATCH_PREPARE_ARGS}
+        return self._batch_prepare_for_model([(ids, None) for ids in batch_ids], **prepare_kwargs)
+
     def _convert_token_to_id(self, token):
         """Converts a token (str) in an id using the vocab."""
         return self.sp_model.piece_to_id(token)
@@ -1632,21 +1891,18 @@ class LLaMATokenizer(PreTrainedTokenizer):
 
     def convert_tokens_to_string(self, tokens):
         """Converts a sequence of tokens (string) in a single string."""
-        current_sub_tokens = []
+        # make sure that special tokens are not decoded using sentencepiece model, every run of
+        # regular tokens between them is decoded with a single sentencepiece call
+        special_tokens = frozenset(self.all_special_tokens)
         out_string = ""
-        prev_is_special = False
-        for token in tokens:
-            # make sure that special tokens are not decoded using sentencepiece model
-            if token in self.all_special_tokens:
-                if not prev_is_special:
-                    out_string += " "
-                out_string += self.sp_model.decode(current_sub_tokens) + token
-                prev_is_special = True
-                current_sub_tokens = []
+        sub_string = ""
+        for is_special, group in groupby(tokens, key=special_tokens.__contains__):
+            if is_special:
+                out_string += " " + sub_string + "".join(group)
+                sub_string = ""
             else:
-                current_sub_tokens.append(token)
-                prev_is_special = False
-        out_string += self.sp_model.decode(current_sub_tokens)
+                sub_string = self.sp_model.decode(list(group))
+        out_string += sub_string
         return out_string.strip()
 
     def save_vocabulary(self, save_directory, filename_prefix: Optional[str] = None) -> Tuple[str]:
@@ -10,10 +10,10 @@ import jax.lax as lax
 import jax.numpy as jnp
 from jax.experimental import pallas as pl
 from jax.experimental.pallas import tpu as pltpu
-from einops import rearrange
 from functools import partial
 import dataclasses
 import functools
+import warnings
 from typing import Any, NamedTuple
 
 
@@ -41,7 +41,7 @@ def _ring_attention_fwd(q, k, v, attn_bias, segment_ids, axis_name, float32_logi
     prev_max_score = jnp.full((batch, num_heads, q_len), -jnp.inf).astype(q.dtype)
     (max_score, numerator, denominator, _, _), _ = lax.scan(scan_kv_block,
         init=(prev_max_score, numerator, denominator, k, v), xs=jnp.arange(0, axis_size))
-    output = numerator / rearrange(denominator, 'b h q -> b q h')[..., None]
+    output = numerator / jnp.swapaxes(denominator, 1, 2)[..., None]
     return output.astype(v.dtype), (output, q, k, v, attn_bias, segment_ids, denominator, max_score)
 
 def _ring_attention_bwd(axis_name, float32_logits, blockwise_kwargs, res, g):
@@ -78,7 +78,7 @@ def ring_attention(q, k, v, attn_bias, segment_ids, axis_name, float32_logits, b
 ring_attention.defvjp(_ring_attention_fwd, _ring_attention_bwd)
 
 
-def _ring_attention_standard_fwd(q, k, v, attn_mask, axis_name, float32_logits):
+def _ring_attention_standard_fwd(q, k, v, attn_bias, axis_name, float32_logits):
     if float32_logits:
         q, k = q.astype(jnp.float32), k.astype(jnp.float32)
     batch, q_len, num_heads, _ = q.shape
@@ -89,13 +89,13 @@ def _ring_attention_standard_fwd(q, k, v, attn_mask, axis_name, float32_logits):
     scale = jnp.sqrt(q.shape[-1])
     def scan_kv_block(carry, idx):
         prev_max_score, numerator, denominator, k, v = carry
-        mask = lax.dynamic_slice_in_dim(attn_mask,
+        bias = lax.dynamic_slice_in_dim(attn_bias,
             (lax.axis_index(axis_name) - idx) % axis_size * kv_len, kv_len, axis=-1)
         attn_weights = jnp.einsum("bqhd,bkhd->bhqk", q, k) / scale
-        attn_weights = jnp.where(mask, attn_weights, jnp.finfo(attn_weights.dtype).min)
+        attn_weights = attn_weights + bias
         max_score = jnp.maximum(prev_max_score, jnp.max(attn_weights, axis=-1))
         exp_weights = jnp.exp(attn_weights - max_score[..., None])
-        correction = rearrange(jnp.exp(prev_max_score - max_score), 'b h q -> b q h')[..., None]
+        correction = jnp.swapaxes(jnp.exp(prev_max_score - max_score), 1, 2)[..., None]
         numerator = numerator * correction + jnp.einsum("bhqk,bkhd->bqhd", exp_weights, v)
         denominator = denominator * jnp.exp(prev_max_score - max_score) + jnp.sum(exp_weights, axis=-1)
         k, v = map(lambda x: lax.ppermute(x, axis_name, perm=[(i,
@@ -104,13 +104,13 @@ def _ring_attention_standard_fwd(q, k, v, attn_mask, axis_name, float32_logits):
     prev_max_score = jnp.full((batch, num_heads, q_len), -jnp.inf).astype(q.dtype)
     (max_score, numerator, denominator, _, _), _ = lax.scan(scan_kv_block,
     init=(prev_max_score, numerator, denominator, k, v), xs=jnp.arange(0, axis_size))
-    output = numerator / rearrange(denominator, 'b h q -> b q h')[..., None]
-    return output.astype(v.dtype), (output, q, k, v, attn_mask, numerator, denominator, max_score)
+    output = numerator / jnp.swapaxes(denominator, 1, 2)[..., None]
+    return output.astype(v.dtype), (output, q, k, v, attn_bias, numerator, denominator, max_score)
 
 def _ring_attention_standard_bwd(axis_name, float32_logits, res, g):
     del float32_logits
     axis_size = lax.psum(1, axis_name)
-    output, q, k, v, attn_mask, numerator, denominator, max_score = res
+    output, q, k, v, attn_bias, numerator, denominator, max_score = res
     dq = jnp.zeros_like(q, dtype=jnp.float32)
     dk = jnp.zeros_like(k, dtype=jnp.float32)
     dv = jnp.zeros_like(v, dtype=jnp.float32)
@@ -118,10 +118,10 @@ def _ring_attention_standard_bwd(axis_name, float32_logits, res, g):
     scale = jnp.sqrt(q.shape[-1])
     def scan_kv_block(carry, idx):
         dq, dk, dv, k, v = carry
-        mask = lax.dynamic_slice_in_dim(attn_mask,
+        bias = lax.dynamic_slice_in_dim(attn_bias,
             (lax.axis_index(axis_name) - idx) % axis_size * kv_len, kv_len, axis=-1)
         attn_weights = jnp.einsum("bqhd,bkhd->bhqk", q, k) / scale
-        attn_weights = jnp.where(mask, attn_weights, jnp.finfo(attn_weights.dtype).min)
+        attn_weights = attn_weights + bias
         exp_weights = jnp.exp(attn_weights - max_score[..., None]) / denominator[..., None]
         ds = jnp.einsum("bqhd,bkhd->bhqk", g, v)
         dl = (ds - jnp.einsum("bqhd,bqhd->bhq", g, output)[..., None]) * exp_weights
@@ -136,13 +136,37 @@ def _ring_attention_standard_bwd(axis_name, float32_logits, res, g):
     return dq, dk, dv, None
 
 @partial(jax.custom_vjp, nondiff_argnums=[4, 5])
-def ring_attention_standard(q, k, v, attn_mask, axis_name, float32_logits=True):
-    y, _ = _ring_attention_standard_fwd(q, k, v, attn_mask, axis_name, float32_logits)
+def ring_attention_standard(q, k, v, attn_bias, axis_name, float32_logits=True):
+    y, _ = _ring_attention_standard_fwd(q, k, v, attn_bias, axis_name, float32_logits)
     return y
 
 ring_attention_standard.defvjp(_ring_attention_standard_fwd, _ring_attention_standard_bwd)
 
 
+def standard_attention(q, k, v, attn_bias, float32_logits=True, fused=False):
+    """Plain softmax attention without ring communication, for when the sequence axis is not sharded.
+    With `fused`, dispatches to `jax.nn.dot_product_attention` where this jax provides it, which picks the
+    cuDNN flash kernel when it supports the inputs instead of materializing the softmax in HBM. Older jax
+    falls back to the unfused path with a warning."""
+    dtype = v.dtype
+    if fused and not hasattr(jax.nn, "dot_product_attention"):
+        warnings.warn(
+            "fused attention needs jax.nn.dot_product_attention, which this jax does not provide, "
+            "falling back to unfused attention"
+        )
+        fused = False
+    if fused:
+        if float32_logits:
+            q, k, v = q.astype(jnp.float32), k.astype(jnp.float32), v.astype(jnp.float32)
+        # the bias stays in float32, a large negative mask value loses precision in bfloat16
+        return jax.nn.dot_product_attention(q, k, v, bias=attn_bias.astype(jnp.float32)).astype(dtype)
+    if float32_logits:
+        q, k = q.astype(jnp.float32), k.astype(jnp.float32)
+    attn_weights = jnp.einsum("bqhd,bkhd->bhqk", q, k) / jnp.sqrt(q.shape[-1])
+    attn_weights = jax.nn.softmax(attn_weights + attn_bias, axis=-1)
+    return jnp.einsum("bhqk,bkhd->bqhd", attn_weights, v).astype(dtype)
+
+
 def _blockwise_attention_fwd(q, k, v, carry, q_chunk_idx_start, k_chunk_idx_start, bias, segment_ids, causal, query_chunk_size,
                              key_chunk_size, deterministic, dropout_rng, attn_pdrop, dtype, policy, precision, prevent_cse):
     batch, q_len, num_heads, dim_per_head = q.shape
@@ -160,7 +184,7 @@ def _blockwise_attention_fwd(q, k, v, carry, q_chunk_idx_start, k_chunk_idx_star
     numerator = jnp.moveaxis(numerator, 1, 0)
     denominator = denominator.reshape((batch, num_heads, num_q, query_chunk_size))
     max_score = max_score.reshape((batch, num_heads, num_q, query_chunk_size))
-    denominator, max_score = map(lambda x: rearrange(x, 'b h n c -> n b h c'), (denominator, max_score))
+    denominator, max_score = map(lambda x: jnp.moveaxis(x, 2, 0), (denominator, max_score))
 
     scale = jnp.sqrt(q.shape[-1])
     if not deterministic and attn_pdrop > 0.0:
@@ -186,7 +210,7 @@ def _blockwise_attention_fwd(q, k, v, carry, q_chunk_idx_start, k_chunk_idx_star
             max_score_chunk = lax.stop_gradient(max_score_chunk)
             exp_weights = jnp.exp(attn_weights - max_score_chunk[..., None])
             exp_values = jnp.einsum('bhqk,bkhd->bqhd', exp_weights, value_chunk, precision=precision)
-            correction = rearrange(jnp.exp(prev_max_score_chunk - max_score_chunk), 'b h q -> b q h')[..., None]
+            correction = jnp.swapaxes(jnp.exp(prev_max_score_chunk - max_score_chunk), 1, 2)[..., None]
             numerator_chunk = numerator_chunk * correction + exp_values
             denominator_chunk = denominator_chunk * jnp.exp(prev_max_score_chunk - max_score_chunk) + exp_weights.sum(axis=-1)
             return (numerator_chunk, denominator_chunk, max_score_chunk), None
@@ -207,13 +231,13 @@ def _blockwise_attention_fwd(q, k, v, carry, q_chunk_idx_start, k_chunk_idx_star
         (numerator_chunk, denominator_chunk, max_score_chunk), _ = lax.scan(
             skip_upper_half, init=(numerator_chunk, denominator_chunk, max_score_chunk), xs=(k, v, jnp.arange(0, num_kv))
         )
-        output_chunk = numerator_chunk / rearrange(denominator_chunk, 'b h q -> b q h')[..., None].astype(dtype)
+        output_chunk = numerator_chunk / jnp.swapaxes(denominator_chunk, 1, 2)[..., None].astype(dtype)
         return (), (output_chunk, numerator_chunk, denominator_chunk, max_score_chunk)
     _, (_, numerator, denominator, max_score) = lax.scan(scan_attention, init=(), xs=(q, numerator, denominator, max_score, jnp.arange(0, num_q)))
 
     numerator = jnp.moveaxis(numerator, 1, 0)
     numerator = numerator.reshape((batch, q_len, num_heads, dim_per_head))
-    denominator, max_score = map(lambda x: rearrange(x, 'n b h c -> b h n c'), (denominator, max_score))
+    denominator, max_score = map(lambda x: jnp.moveaxis(x, 0, 2), (denominator, max_score))
     denominator = denominator.reshape((batch, num_heads, q_len))
     max_score = max_score.reshape((batch, num_heads, q_len))
 
@@ -236,7 +260,7 @@ def _blockwise_attention_bwd(q, k, v, g, carry, q_chunk_idx_start, k_chunk_idx_s
 
     denominator = denominator.reshape((batch, num_heads, num_q, query_chunk_size))
     max_score = max_score.reshape((batch, num_heads, num_q, query_chunk_size))
-    denominator, max_score = map(lambda x: rearrange(x, 'b h n c -> n b h c'), (denominator, max_score))
+    denominator, max_score = map(lambda x: jnp.moveaxis(x, 2, 0), (denominator, max_score))
 
     q = q.reshape((batch, num_q, query_chunk_size, num_heads, dim_per_head))
     k = k.reshape((batch, num_kv, key_chunk_size, num_heads, dim_per_head))
@@ -307,7 +331,7 @@ def _blockwise_attention_bwd(q, k, v, g, carry, q_chunk_idx_start, k_chunk_idx_s
 
 # Blockwise feedforward network for memory-efficient training
 def blockwise_ffn(remat_ffn, inputs, chunk_size, deterministic):
-    inputs = rearrange(inputs, 'b (c n) d -> b c n d', c=chunk_size)
+    inputs = inputs.reshape(inputs.shape[0], chunk_size, -1, inputs.shape[-1])
     def scan_ffn(remat_ffn, carry, hidden_states):
         outputs = remat_ffn(hidden_states, deterministic=deterministic)
         return carry, outputs
@@ -319,7 +343,7 @@ def blockwise_ffn(remat_ffn, inputs, chunk_size, deterministic):
         in_axes=scan_axis,
         out_axes=scan_axis,
     )(remat_ffn, None, inputs)
-    output = rearrange(output, 'b c n d -> b (c n) d')
+    output = output.reshape(output.shape[0], -1, output.shape[-1])
     return output
 
 
@@ -377,7 +401,7 @@ def _chunk_attention_bias(query_chunk_size, key_chunk_size,
 def _ring_flash_attention_fwd_tpu(q, k, v, attn_bias, segment_ids, axis_name, float32_logits, blockwise_kwargs):
     if float32_logits:
         q, k = q.astype(jnp.float32), k.astype(jnp.float32)
-    q, k, v = map(lambda x: rearrange(x, 'b q h d -> b h q d'), [q, k, v])
+    q, k, v = map(lambda x: jnp.swapaxes(x, 1, 2), [q, k, v])
     batch, num_heads, q_len, dim_per_head = q.shape
     batch, num_heads, kv_len, dim_per_head = k.shape
     attn_bias = attn_bias[:, 0, 0] # (batch, k_len)
@@ -446,7 +470,7 @@ def _ring_flash_attention_fwd_tpu(q, k, v, attn_bias, segment_ids, axis_name, fl
         return (o, l, m, k, v), None
     (o, l, m, _, _), _ = lax.scan(scan_kv_block,
         init=(o, l, m, k, v), xs=jnp.arange(0, axis_size))
-    output = rearrange(o.astype(v.dtype), 'b h q d -> b q h d')
+    output = jnp.swapaxes(o.astype(v.dtype), 1, 2)
     return output, (o, q, k, v, attn_bias, segment_ids, l, m)
 
 def _ring_flash_attention_bwd_tpu(axis_name, float32_logits, blockwise_kwargs, res, g):
@@ -468,7 +492,7 @@ def _ring_flash_attention_bwd_tpu(axis_name, float32_logits, blockwise_kwargs, r
             lax.axis_index(axis_name) * q_block_size, q_block_size, axis=-1
         )
 
-    g = rearrange(g, 'b q h d -> b h q d')
+    g = jnp.swapaxes(g, 1, 2)
 
     block_sizes = BlockSizes(
         block_q=query_chunk_size,
@@ -521,7 +545,7 @@ def _ring_flash_attention_bwd_tpu(axis_name, float32_logits, blockwise_kwargs, r
         return (dq, dk, dv, k, v), None
     (dq, dk, dv, k, v), _ = lax.scan(scan_kv_block, init=(dq, dk, dv, k, v), xs=jnp.arange(0, axis_size))
     dq, dk, dv = dq.astype(q.dtype), dk.astype(k.dtype), dv.astype(v.dtype)
-    dq, dk, dv = map(lambda x: rearrange(x, 'b h q d -> b q h d'), (dq, dk, dv))
+    dq, dk, dv = map(lambda x: jnp.swapaxes(x, 1, 2), (dq, dk, dv))
     return dq, dk, dv, None, None
 
 @partial(jax.custom_vjp, nondiff_argnums=[5, 6, 7])
@@ -12,6 +12,7 @@ import jax
 import jax.numpy as jnp
 from jax.experimental.pjit import pjit
 from jax.sharding import PartitionSpec as PS
+from flax.serialization import from_state_dict
 from flax.training.train_state import TrainState
 
 from mwm.data import DatasetFactory
@@ -20,9 +21,9 @@ from tux import (
     cross_entropy_loss_and_accuracy, global_norm, get_float_dtype_by_name,
     set_random_seed, average_metrics, get_mask,
     make_shard_and_gather_fns, with_sharding_constraint, define_flags_with_default,
-    OptimizerFactory, StreamingCheckpointer
+    OptimizerFactory, StreamingCheckpointer, tree_apply
 )
-from mwm.llama import LLaMAConfig, FlaxLLaMAForCausalLMModule
+from mwm.llama import LLaMAConfig, FlaxLLaMAForCausalLMModule, fuse_projection_params
 from mwm.vision_llama import VideoLLaMAConfig, FlaxVideoLLaMAForCausalLMModule
 
 
@@ -114,6 +115,11 @@ def main(argv):
             scan_mlp_chunk_size=updates.scan_mlp_chunk_size,
             scan_layers=updates.scan_layers,
             param_scan_axis=updates.param_scan_axis,
+            scan_checkpoint_groups=updates.scan_checkpoint_groups,
+            scan_remat_block=updates.scan_remat_block,
+            strict_partition=updates.strict_partition,
+            param_dtype=updates.param_dtype,
+            compute_dtype=updates.compute_dtype,
         ))
     else:
         llama_config = config_cls(**FLAGS.llama)
@@ -272,7 +278,9 @@ def main(argv):
 
     train_state_shapes = jax.eval_shape(init_fn, next_rng())
     train_state_partition = match_partition_rules(
-        config_cls.get_partition_rules(llama_config.scan_layers, llama_config.param_scan_axis), train_state_shapes
+        config_cls.get_partition_rules(
+            llama_config.scan_layers, llama_config.param_scan_axis, llama_config.strict_partition
+        ), train_state_shapes
     )
 
     shard_fns, gather_fns = make_shard_and_gather_fns(
@@ -339,10 +347,21 @@ def main(argv):
             train_state, restored_params = checkpointer.load_trainstate_checkpoint(
                 resume_path, train_state_shapes, shard_fns, max_buffer_size=32 * 2 ** 30
             )
-        elif FLAGS.load_checkpoint != '':
+        elif FLAGS.load_checkpoint.startswith('trainstate::'):
             train_state, restored_params = checkpointer.load_trainstate_checkpoint(
                 FLAGS.load_checkpoint, train_state_shapes, shard_fns, max_buffer_size=32 * 2 ** 30
             )
+        elif FLAGS.load_checkpoint != '':
+            # Params only checkpoints may predate the packed wqkv/w13 projections, so they are
+            # loaded on the host without the packed target, converted and then sharded
+            with jax.default_device(jax.devices("cpu")[0]):
+                _, restored_params = checkpointer.load_trainstate_checkpoint(
+                    FLAGS.load_checkpoint, max_buffer_size=32 * 2 ** 30
+                )
+                restored_params = from_state_dict(
+                    train_state_shapes.params, fuse_projection_params(restored_params)
+                )
+            restored_params = tree_apply(shard_fns.params, restored_params)
 
         if train_state is None and restored_params is None:
             # Initialize from scratch
@@ -1,5 +1,6 @@
 from absl.app import run
 import math
+from collections import OrderedDict
 from tqdm import tqdm
 from PIL import Image
 import decord
@@ -15,6 +16,7 @@ from tux import (
     match_partition_rules, make_shard_and_gather_fns,
     with_sharding_constraint, tree_apply, open_file
 )
+from mwm.llama import fuse_projection_params
 from mwm.vision_llama import VideoLLaMAConfig, FlaxVideoLLaMAForCausalLM
 from mwm.vqgan import VQGAN
 
@@ -25,6 +27,7 @@ FLAGS, FLAGS_DEF = define_flags_with_default(
     vqgan_checkpoint="",
     temperature=0.2,
     max_n_frames=8,
+    vision_cache_size=16,
     seed=1234,
     mesh_dim='1,-1,1,1',
     dtype='fp32',
@@ -48,6 +51,9 @@ class Sampler:
         self.n_tokens_per_frame = 257
         self.min_buffer_size = 256
         self.sharded_rng = next_rng()
+        # LRU of VQGAN encodings keyed by (input_path, max_n_frames), so repeated questions about
+        # the same image or video reuse the tokenized vision prefix instead of re-encoding every frame
+        self._vision_cache = OrderedDict()
         self._load_model()
 
     @property
@@ -109,6 +115,18 @@ class Sampler:
                     encodings.append(8192)
         return encodings
 
+    def _cached_vision(self, path, max_n_frames):
+        key = (path, max_n_frames)
+        if key in self._vision_cache:
+            self._vision_cache.move_to_end(key)
+            return self._vision_cache[key]
+        vision = self._read_process_vision(path, max_n_frames)
+        if FLAGS.vision_cache_size > 0:
+            self._vision_cache[key] = vision
+            if len(self._vision_cache) > FLAGS.vision_cache_size:
+                self._vision_cache.popitem(last=False)
+        return vision
+
     def construct_input(self, prompts, max_n_frames):
         max_input_length = max_n_frames * self.n_tokens_per_frame + self.min_buffer_size
         max_input_length = int(math.ceil(max_input_length / self.block_size) * self.block_size)
@@ -120,7 +138,7 @@ class Sampler:
         vision_masks = np.zeros((len(prompts), max_input_length), dtype=bool)
         attention_mask = np.zeros((len(prompts), max_input_length), dtype=int)
         for i, prompt in enumerate(tqdm(prompts)):
-            vision = self._read_process_vision(prompt['input_path'], max_n_frames)
+            vision = self._cached_vision(prompt['input_path'], max_n_frames)
             text_1 = self.tokenizer.encode(f"<s>You are a helpful assistant. USER: {prompt['question']}\n")
             tail = self.tokenizer.encode(" ASSISTANT:")
             
@@ -162,6 +180,7 @@ class Sampler:
                 scan_mlp_chunk_size=updates.scan_mlp_chunk_size,
                 scan_layers=updates.scan_layers,
                 param_scan_axis=updates.param_scan_axis,
+                kv_cache_dtype=updates.kv_cache_dtype,
             ))
         else:
             llama_config = VideoLLaMAConfig(**FLAGS.llama)
@@ -188,8 +207,12 @@ class Sampler:
             _, self.params = StreamingCheckpointer.load_trainstate_checkpoint(
                     FLAGS.load_checkpoint, disallow_trainstate=True, max_buffer_size=32 * 2 ** 30
             )
+            # checkpoints saved before the packed wqkv/w13 projections store the kernels separately
+            self.params = fuse_projection_params(self.params)
         self.model_ps = match_partition_rules(
-            VideoLLaMAConfig.get_partition_rules(llama_config.scan_layers, llama_config.param_scan_axis), self.params
+            VideoLLaMAConfig.get_partition_rules(
+                llama_config.scan_layers, llama_config.param_scan_axis, llama_config.strict_partition
+            ), self.params
         )
         shard_fns, _ = make_shard_and_gather_fns(
             self.model_ps, get_float_dtype_by_name(FLAGS.dtype)
@@ -14,6 +14,7 @@ from tux import (
     match_partition_rules, make_shard_and_gather_fns,
     with_sharding_constraint, tree_apply, next_rng
 )
+from mwm.llama import fuse_projection_params
 from mwm.vision_llama import VideoLLaMAConfig, FlaxVideoLLaMAForCausalLM
 from mwm.vqgan import VQGAN
 
@@ -74,6 +75,7 @@ def main(argv):
             scan_mlp_chunk_size=updates.scan_mlp_chunk_size,
             scan_layers=updates.scan_layers,
             param_scan_axis=updates.param_scan_axis,
+            kv_cache_dtype=updates.kv_cache_dtype,
         ))
     else:
         llama_config = VideoLLaMAConfig(**FLAGS.llama)
@@ -91,6 +93,8 @@ def main(argv):
         _, params = StreamingCheckpointer.load_trainstate_checkpoint(
                 FLAGS.load_checkpoint, disallow_trainstate=True, max_buffer_size=32 * 2 ** 30
         )
+        # checkpoints saved before the packed wqkv/w13 projections store the kernels separately
+        params = fuse_projection_params(params)
         model = FlaxVideoLLaMAForCausalLM(
             llama_config, 
             input_shape=(512, 8192),
@@ -99,7 +103,9 @@ def main(argv):
             dtype=get_float_dtype_by_name(FLAGS.dtype),
         )
         model_ps = match_partition_rules(
-            VideoLLaMAConfig.get_partition_rules(llama_config.scan_layers, llama_config.param_scan_axis), params
+            VideoLLaMAConfig.get_partition_rules(
+                llama_config.scan_layers, llama_config.param_scan_axis, llama_config.strict_partition
+            ), params
         )
         shard_fns, _ = make_shard_and_gather_fns(
             model_ps, get_float_dtype_by_name(FLAGS.dtype)
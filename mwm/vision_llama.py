@@ -2,6 +2,7 @@ from typing import Any, Dict, List, Optional, Tuple, Union
 import json
 import warnings
 import copy
+from functools import partial
 
 import jax
 import jax.numpy as jnp
@@ -18,7 +19,8 @@ from transformers.utils import add_start_docstrings, add_start_docstrings_to_mod
 from transformers import GenerationConfig
 
 from tux import load_pickle, open_file
-from mwm.llama import LLaMAConfig, LLAMA_STANDARD_CONFIGS, FlaxLLaMABlockCollection, RMSNorm
+from mwm.llama import LLaMAConfig, LLAMA_STANDARD_CONFIGS, FlaxLLaMABlockCollection, RMSNorm, fuse_projection_params, \
+    build_generation_inputs, tied_embedding_logits
 
 
 VIDEO_LLAMA_STANDARD_CONFIGS = LLAMA_STANDARD_CONFIGS
@@ -34,12 +36,14 @@ class VideoLLaMAConfig(LLaMAConfig):
         self.sample_mode = sample_mode
 
     @staticmethod
-    def get_partition_rules(scan_layers=False, scan_axis=0):
+    def get_partition_rules(scan_layers=False, scan_axis=0, strict=False):
         """ Parition rules for GPTJ. Note that these rules are orderd, so that
             the beginning rules match first. It is important to use
             PartitionSpec() instead of None here because JAX does not treat
-            None as a pytree leaf.
+            None as a pytree leaf. With strict, params matching no rule raise
+            instead of being silently replicated.
         """
+        fallback = () if strict else (('.*', PS(None)),)
         if scan_layers:
             if scan_axis == 0:
                 return (
@@ -47,12 +51,11 @@ class VideoLLaMAConfig(LLaMAConfig):
                     ("transformer/wte/embedding", PS("tp", ("fsdp", "sp"))),
                     ("transformer/vte/embedding", PS("tp", ("fsdp", "sp"))),
                     # atention
-                    ("attention/(wq|wk|wv)/kernel", PS(None, ("fsdp", "sp"), "tp")),
+                    ("attention/wqkv/kernel", PS(None, ("fsdp", "sp"), "tp")),
                     ("attention/wo/kernel", PS(None, "tp", ("fsdp", "sp"))),
                     # mlp
-                    ("feed_forward/w1/kernel", PS(None, ("fsdp", "sp"), "tp")),
+                    ("feed_forward/w13/kernel", PS(None, ("fsdp", "sp"), "tp")),
                     ("feed_forward/w2/kernel", PS(None, "tp", ("fsdp", "sp"))),
-                    ("feed_forward/w3/kernel", PS(None, ("fsdp", "sp"), "tp")),
                     # layer norms
                     ("attention_norm/kernel", PS(None, None)),
                     ("ffn_norm/kernel", PS(None, None)),
@@ -60,20 +63,18 @@ class VideoLLaMAConfig(LLaMAConfig):
                     ("transformer/ln_f/kernel", PS(None)),
                     ("lm_head/kernel", PS(("fsdp", "sp"), "tp")),
                     ("vision_head/kernel", PS(("fsdp", "sp"), "tp")),
-                    ('.*', PS(None)),
-                )
+                ) + fallback
             elif scan_axis == 1:
                 return (
                     # embeddings
                     ("transformer/wte/embedding", PS("tp", ("fsdp", "sp"))),
                     ("transformer/vte/embedding", PS("tp", ("fsdp", "sp"))),
                     # atention
-                    ("attention/(wq|wk|wv)/kernel", PS(("fsdp", "sp"), None, "tp")),
+                    ("attention/wqkv/kernel", PS(("fsdp", "sp"), None, "tp")),
                     ("attention/wo/kernel", PS("tp", None, ("fsdp", "sp"))),
                     # mlp
-                    ("feed_forward/w1/kernel", PS(("fsdp", "sp"), None, "tp")),
+                    ("feed_forward/w13/kernel", PS(("fsdp", "sp"), None, "tp")),
                     ("feed_forward/w2/kernel", PS("tp", None, ("fsdp", "sp"))),
-                    ("feed_forward/w3/kernel", PS(("fsdp", "sp"), None, "tp")),
                     # layer norms
                     ("attention_norm/kernel", PS(None, None)),
                     ("ffn_norm/kernel", PS(None, None)),
@@ -81,8 +82,7 @@ class VideoLLaMAConfig(LLaMAConfig):
                     ("transformer/ln_f/kernel", PS(None)),
                     ("lm_head/kernel", PS(("fsdp", "sp"), "tp")),
                     ("vision_head/kernel", PS(("fsdp", "sp"), "tp")),
-                    ('.*', PS(None)),
-                )
+                ) + fallback
             else:
                 raise ValueError(f"Invalid scan_axis {scan_axis}")
         else:
@@ -91,12 +91,11 @@ class VideoLLaMAConfig(LLaMAConfig):
                 ("transformer/wte/embedding", PS("tp", ("fsdp", "sp"))),
                 ("transformer/vte/embedding", PS("tp", ("fsdp", "sp"))),
                 # atention
-                ("attention/(wq|wk|wv)/kernel", PS(("fsdp", "sp"), "tp")),
+                ("attention/wqkv/kernel", PS(("fsdp", "sp"), "tp")),
                 ("attention/wo/kernel", PS("tp", ("fsdp", "sp"))),
                 # mlp
-                ("feed_forward/w1/kernel", PS(("fsdp", "sp"), "tp")),
+                ("feed_forward/w13/kernel", PS(("fsdp", "sp"), "tp")),
                 ("feed_forward/w2/kernel", PS("tp", ("fsdp", "sp"))),
-                ("feed_forward/w3/kernel", PS(("fsdp", "sp"), "tp")),
                 # layer norms
                 ("attention_norm/kernel", PS(None)),
                 ("ffn_norm/kernel", PS(None)),
@@ -104,8 +103,7 @@ class VideoLLaMAConfig(LLaMAConfig):
                 ("transformer/ln_f/kernel", PS(None)),
                 ("lm_head/kernel", PS(("fsdp", "sp"), "tp")),
                 ("vision_head/kernel", PS(("fsdp", "sp"), "tp")),
-                ('.*', PS(None)),
-            )
+            ) + fallback
 
     @classmethod
     def load_config(cls, path):
@@ -152,10 +150,12 @@ class FlaxVideoLLaMAPreTrainedModel(FlaxPreTrainedModel):
         position_ids = jnp.broadcast_to(jnp.arange(jnp.atleast_2d(input_ids).shape[-1]), input_ids.shape)
         vision_masks = jnp.ones((batch_size, max_length), dtype=bool)
 
-        init_variables = self.module.init(
-            jax.random.PRNGKey(0), input_ids, vision_masks, attention_mask, segment_ids, position_ids, return_dict=False, init_cache=True
+        # see FlaxLLaMAPreTrainedModel.init_cache
+        init_variables = jax.eval_shape(
+            partial(self.module.init, return_dict=False, init_cache=True),
+            jax.random.PRNGKey(0), input_ids, vision_masks, attention_mask, segment_ids, position_ids
         )
-        return init_variables["cache"]
+        return jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), init_variables["cache"])
 
     def init_weights(self, rng, input_shape, params=None):
         # init input tensors
@@ -171,7 +171,7 @@ class FlaxVideoLLaMAPreTrainedModel(FlaxPreTrainedModel):
 
         if params is not None:
             random_params = flatten_dict(unfreeze(random_params))
-            params = flatten_dict(unfreeze(params))
+            params = flatten_dict(unfreeze(fuse_projection_params(params)))
             for missing_key in self._missing_keys:
                 params[missing_key] = random_params[missing_key]
             self._missing_keys = set()
@@ -207,13 +207,13 @@ class FlaxVideoLLaMAPreTrainedModel(FlaxPreTrainedModel):
             if past_key_values is not None:
                 raise ValueError("Make sure to provide `position_ids` when passing `past_key_values`.")
 
-            position_ids = jnp.broadcast_to(jnp.arange(sequence_length)[None, :], (batch_size, sequence_length))
+            position_ids = jnp.broadcast_to(jnp.arange(sequence_length, dtype="i4")[None, :], (batch_size, sequence_length))
 
         if attention_mask is None:
-            attention_mask = jnp.ones((batch_size, sequence_length))
+            attention_mask = jnp.ones((batch_size, sequence_length), dtype="i4")
         
         if segment_ids is None:
-            segment_ids = jnp.zeros((batch_size, sequence_length))
+            segment_ids = jnp.zeros((batch_size, sequence_length), dtype="i4")
 
         # Handle any PRNG if needed
         rngs = {}
@@ -231,11 +231,11 @@ class FlaxVideoLLaMAPreTrainedModel(FlaxPreTrainedModel):
 
         outputs = self.module.apply(
             inputs,
-            jnp.array(input_ids, dtype="i4"),
-            jnp.array(vision_masks, dtype="f4"),
-            jnp.array(attention_mask, dtype="i4"),
-            jnp.array(segment_ids, dtype="i4"),
-            jnp.array(position_ids, dtype="i4"),
+            jnp.asarray(input_ids, dtype="i4"),
+            jnp.asarray(vision_masks, dtype="f4"),
+            jnp.asarray(attention_mask, dtype="i4"),
+            jnp.asarray(segment_ids, dtype="i4"),
+            jnp.asarray(position_ids, dtype="i4"),
             not train,
             False,
             output_attentions,
@@ -387,15 +387,18 @@ class FlaxVideoLLaMAForCausalLMModule(nn.Module):
         return_dict: bool = True,
     ):
         batch_size, seq_length = input_ids.shape
+        if position_ids is None:
+            # computed once here and threaded to every layer; without a mask the
+            # cumsum is just an arange, so skip it on the default training path
+            if attention_mask is None:
+                position_ids = jnp.arange(seq_length, dtype=jnp.int32)[None, :]
+            else:
+                position_ids = jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0)
+            position_ids = jnp.broadcast_to(position_ids, (batch_size, seq_length))
         if attention_mask is None:
             attention_mask = jnp.ones_like(input_ids)
         if segment_ids is None:
             segment_ids = jnp.zeros_like(input_ids)
-        if position_ids is None:
-            position_ids = jnp.broadcast_to(
-                jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0),
-                (batch_size, seq_length)
-            )
 
             
         outputs = self.transformer(
@@ -414,14 +417,16 @@ class FlaxVideoLLaMAForCausalLMModule(nn.Module):
         hidden_states = outputs[0]
 
         if self.config.tie_vision_embeddings:
-            shared_kernel = self.transformer.variables["params"]["vte"]["embedding"].T
-            vision_logits = self.vision_head.apply({"params": {"kernel": shared_kernel}}, hidden_states)
+            vision_logits = tied_embedding_logits(
+                hidden_states, self.transformer.variables["params"]["vte"]["embedding"], self.dtype, self.precision
+            )
         else:
             vision_logits = self.vision_head(hidden_states)
 
         if self.config.tie_word_embeddings:
-            shared_kernel = self.transformer.variables["params"]["wte"]["embedding"].T
-            lm_logits = self.lm_head.apply({"params": {"kernel": shared_kernel}}, hidden_states)
+            lm_logits = tied_embedding_logits(
+                hidden_states, self.transformer.variables["params"]["wte"]["embedding"], self.dtype, self.precision
+            )
         else:
             lm_logits = self.lm_head(hidden_states)
 
@@ -459,12 +464,7 @@ class FlaxVideoLLaMAForCausalLM(FlaxVideoLLaMAPreTrainedModel):
         # Note that usually one would have to put 0's in the attention_mask for x > input_ids.shape[-1] and x < cache_length.
         # But since GPTJ uses a causal mask, those positions are masked anyways.
         # Thus we can create a single static attention_mask here, which is more efficient for compilation
-        extended_attention_mask = jnp.ones((batch_size, max_length), dtype="i4")
-        if attention_mask is not None:
-            position_ids = attention_mask.cumsum(axis=-1) - 1
-            extended_attention_mask = lax.dynamic_update_slice(extended_attention_mask, attention_mask, (0, 0))
-        else:
-            position_ids = jnp.broadcast_to(jnp.arange(seq_length, dtype="i4")[None, :], (batch_size, seq_length))
+        extended_attention_mask, position_ids = build_generation_inputs(input_ids, attention_mask, max_length)
 
         return {
             "past_key_values": past_key_values,
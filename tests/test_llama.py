@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import jax
+import jax.numpy as jnp
+from flax.serialization import from_state_dict
+from transformers.modeling_flax_utils import FlaxPreTrainedModel
+
+from tux import StreamingCheckpointer
+from mwm.llama import LLaMAConfig, FlaxLLaMAForCausalLM, fuse_projection_params
+
+
+def save_legacy_checkpoint(tmp_path, params):
+    checkpointer = StreamingCheckpointer(
+        StreamingCheckpointer.get_default_config(), str(tmp_path)
+    )
+    checkpointer.save_checkpoint({'params': {'params': params}}, 'streaming_params')
+    return f"trainstate_params::{tmp_path}/streaming_params"
+
+
+def test_load_checkpoint_with_separate_qkv(tmp_path):
+    rng = np.random.default_rng(0)
+    attention = {
+        name: {'kernel': rng.standard_normal((8, 8)).astype(np.float32)}
+        for name in ('wq', 'wk', 'wv', 'wo')
+    }
+    legacy = {'transformer': {'h': {'0': {'attention': attention}}}}
+
+    _, restored = StreamingCheckpointer.load_trainstate_checkpoint(
+        save_legacy_checkpoint(tmp_path, legacy)
+    )
+    restored = fuse_projection_params(restored)
+
+    target = {'params': {'transformer': {'h': {'0': {'attention': {
+        'wqkv': {'kernel': jax.ShapeDtypeStruct((8, 24), jnp.float32)},
+        'wo': {'kernel': jax.ShapeDtypeStruct((8, 8), jnp.float32)},
+    }}}}}}
+    restored = from_state_dict(target, restored)
+
+    fused = restored['params']['transformer']['h']['0']['attention']
+    np.testing.assert_array_equal(
+        fused['wqkv']['kernel'],
+        np.concatenate([attention[name]['kernel'] for name in ('wq', 'wk', 'wv')], axis=-1),
+    )
+    np.testing.assert_array_equal(fused['wo']['kernel'], attention['wo']['kernel'])
+
+
+def test_load_checkpoint_with_separate_w1_w3(tmp_path):
+    rng = np.random.default_rng(0)
+    feed_forward = {
+        'w1': {'kernel': rng.standard_normal((8, 16)).astype(np.float32)},
+        'w2': {'kernel': rng.standard_normal((16, 8)).astype(np.float32)},
+        'w3': {'kernel': rng.standard_normal((8, 16)).astype(np.float32)},
+    }
+    legacy = {'transformer': {'h': {'0': {'feed_forward': feed_forward}}}}
+
+    _, restored = StreamingCheckpointer.load_trainstate_checkpoint(
+        save_legacy_checkpoint(tmp_path, legacy)
+    )
+    restored = fuse_projection_params(restored)
+
+    target = {'params': {'transformer': {'h': {'0': {'feed_forward': {
+        'w13': {'kernel': jax.ShapeDtypeStruct((8, 32), jnp.float32)},
+        'w2': {'kernel': jax.ShapeDtypeStruct((16, 8), jnp.float32)},
+    }}}}}}
+    restored = from_state_dict(target, restored)
+
+    fused = restored['params']['transformer']['h']['0']['feed_forward']
+    np.testing.assert_array_equal(
+        fused['w13']['kernel'],
+        np.concatenate([feed_forward['w1']['kernel'], feed_forward['w3']['kernel']], axis=-1),
+    )
+    np.testing.assert_array_equal(fused['w2']['kernel'], feed_forward['w2']['kernel'])
+
+
+def tiny_causal_lm(**updates):
+    config = LLaMAConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, max_sequence_length=128, scan_layers=False,
+        use_flash_attention=False, pad_token_id=0, **updates,
+    )
+    return FlaxLLaMAForCausalLM(config, input_shape=(1, 128), seed=0)
+
+
+def test_bucket_padded_generation_matches_unpadded():
+    model = tiny_causal_lm()
+    # 10 prompt tokens are left padded to the 64 token bucket
+    input_ids = jnp.arange(1, 11, dtype=jnp.int32)[None]
+    with LLaMAConfig.get_jax_mesh('1,1,1,1'):
+        padded = model.generate(input_ids, max_new_tokens=4, do_sample=False).sequences
+        unpadded = FlaxPreTrainedModel.generate(
+            model, input_ids, max_new_tokens=4, do_sample=False
+        ).sequences
+    np.testing.assert_array_equal(padded, unpadded)
+
+
+def test_contiguous_position_ids_rejects_padded_prompts():
+    model = tiny_causal_lm(contiguous_position_ids=True)
+    input_ids = jnp.arange(1, 11, dtype=jnp.int32)[None]
+    attention_mask = jnp.ones_like(input_ids).at[:, :2].set(0)
+    with LLaMAConfig.get_jax_mesh('1,1,1,1'), pytest.raises(ValueError):
+        model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=4, do_sample=False)
@@ -1,18 +1,85 @@
-import logging
+import glob
 import os
 import sqlite3
 from typing import Optional, List
+from urllib.request import pathname2url
 
 import numpy as np
 from transformers import AutoTokenizer
 import torch
 import zstandard
+from numba import njit
 from pytorch_lightning import LightningDataModule
 from pytorch_lightning.utilities.cli import DATAMODULE_REGISTRY
 from pytorch_lightning.utilities.types import EVAL_DATALOADERS, TRAIN_DATALOADERS
-from sortedcontainers import SortedList
 from torch.utils.data import DataLoader, Dataset
 
+from utils import RAW_SEQ_VERSION
+
+
+@njit(cache=True, boundscheck=False)
+def parse_row(buf, pred_start, pad_id, tokens, weights):
+    """
+    Parses a decompressed row of space separated ASCII token ids in a single pass over `buf`, writing
+    the padded token ids into `tokens` (length `max_seq_len + 1`) and the loss mask into `weights`
+    (length `max_seq_len`) in place. Raises if the row holds more than `max_seq_len + 1` tokens.
+    """
+    tokens[:] = pad_id
+    weights[:] = 0
+
+    n = 0
+    value = 0
+    in_token = False
+    for i in range(buf.shape[0]):
+        c = buf[i]
+        if 48 <= c <= 57:
+            value = value * 10 + (c - 48)
+            in_token = True
+        elif in_token:
+            if n == tokens.shape[0]:
+                raise ValueError("row is longer than max_seq_len + 1 tokens")
+            tokens[n] = value
+            n += 1
+            value = 0
+            in_token = False
+    if in_token:
+        if n == tokens.shape[0]:
+            raise ValueError("row is longer than max_seq_len + 1 tokens")
+        tokens[n] = value
+        n += 1
+
+    for i in range(max(pred_start - 1, 0), min(n - 1, weights.shape[0])):
+        weights[i] = 1
+
+
+@njit(cache=True, boundscheck=False)
+def fill_row(ids, pred_start, pad_id, tokens, weights):
+    """
+    Same as `parse_row` for rows stored as raw int32 token `ids`.
+    """
+    n = ids.shape[0]
+    if n > tokens.shape[0]:
+        raise ValueError("row is longer than max_seq_len + 1 tokens")
+    tokens[:n] = ids
+    tokens[n:] = pad_id
+    weights[:] = 0
+
+    for i in range(max(pred_start - 1, 0), min(n - 1, weights.shape[0])):
+        weights[i] = 1
+
+
+def connect_readonly(fpath):
+    """
+    Opens a Pile DB read-only. The DBs are never written after `prepare_data.py`, so they are opened `immutable`,
+    which lets SQLite skip file locking and change detection entirely, and are read through mmap.
+    """
+    uri = f"file:{pathname2url(os.path.abspath(fpath))}?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA mmap_size=1099511627776")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
 
 class PileRandomIODataset(Dataset):
     """
@@ -24,13 +91,17 @@ class PileRandomIODataset(Dataset):
         self.max_seq_len = max_seq_len
         self.pad_id = pad_id
         self.decompressor = None
+        # Read-only connections, opened lazily per worker and kept for its lifetime. See `get_connection`.
+        self._conns = {}
+        # Whether each DB stores raw int32 `seq` blobs, see `recompress_pile.py`.
+        self._raw_seq = {}
 
         self.length = 0
         self.index = []
-        self.index_keys = SortedList()
+        index_keys = []
         for i, fpath in enumerate(self.fpaths):
             # Connect to DB and get the rows count in each DB.
-            conn = sqlite3.connect(fpath)
+            conn = connect_readonly(fpath)
             num_rows = conn.execute("SELECT COUNT(*) FROM rows").fetchall()[0][0]
             conn.close()
 
@@ -38,10 +109,28 @@ class PileRandomIODataset(Dataset):
             self.length += num_rows
             # Create data structures that are required to implement random access.
             # Maps the index argument of __getitem__ to the DB path and the key in the DB.
-            # Stores the length of each DB in a SortableList data structure.
+            # Stores the cumulative length up to and including each DB, searched with np.searchsorted.
             self.index.append(fpath)
-            self.index_keys.add(self.length)
+            index_keys.append(self.length)
             print(f"DB {fpath} has {num_rows} rows. Total rows {self.length}")
+        self.index_keys = np.asarray(index_keys, dtype=np.int64)
+
+    def get_connection(self, fpath):
+        conn = self._conns.get(fpath)
+        if conn is None:
+            conn = connect_readonly(fpath)
+            self._conns[fpath] = conn
+            self._raw_seq[fpath] = conn.execute("PRAGMA user_version").fetchall()[0][0] == RAW_SEQ_VERSION
+        return conn
+
+    def close_connections(self):
+        for conn in self._conns.values():
+            conn.close()
+        self._conns = {}
+        self._raw_seq = {}
+
+    def __del__(self):
+        self.close_connections()
 
     def get_decompressor(self):
         if self.decompressor is None:
@@ -53,43 +142,91 @@ class PileRandomIODataset(Dataset):
 
     def _get_db_and_idx(self, idx):
         # Refer to the blog for more details on this.
-        key = self.index_keys.bisect_left(idx + 1)
+        key = int(np.searchsorted(self.index_keys, idx + 1, side="left"))
         fpath = self.index[key]
 
-        key_offset = 0 if key == 0 else self.index_keys[key - 1]
+        key_offset = 0 if key == 0 else int(self.index_keys[key - 1])
         db_key = idx - key_offset
 
         return fpath, db_key
 
     def __getitem__(self, idx):
-        try:
+        fpath, db_idx = self._get_db_and_idx(idx)
+        # Reuse the worker's connection, sqlite caches the compiled statement per connection.
+        conn = self.get_connection(fpath)
+        dataset, seq, pred_start = conn.execute(
+            "SELECT dataset, seq, pred_start FROM rows WHERE id == ?", (db_idx,)
+        ).fetchall()[0]
+
+        tokens = np.empty(self.max_seq_len + 1, dtype=np.int32)
+        weights = np.empty(self.max_seq_len, dtype=np.uint8)
+        self._fill_row(fpath, seq, pred_start, tokens, weights)
+
+        return tokens, weights, dataset
+
+    def __getitems__(self, idxs):
+        # Called by the DataLoader with a whole minibatch of indices. Rows are fetched with one
+        # `WHERE id IN (...)` query per DB instead of one query per sample, and parsed straight into
+        # the batch tensors, so the result is already collated. See `collate_batch`.
+        tokens = torch.empty((len(idxs), self.max_seq_len + 1), dtype=torch.int32)
+        weights = torch.empty((len(idxs), self.max_seq_len), dtype=torch.uint8)
+        tokens_np, weights_np = tokens.numpy(), weights.numpy()
+
+        db_keys = {}
+        for i, idx in enumerate(idxs):
             fpath, db_idx = self._get_db_and_idx(idx)
-            # Open connection for each call. This is not expensive and does not impact speed. Also, kills potential
-            # complexity that can arise from keeping many connections open for a long time.
-            conn = sqlite3.connect(fpath)
-            dataset, seq, pred_start = conn.execute(
-                "SELECT dataset, seq, pred_start FROM rows WHERE id == ?", (db_idx,)
-            ).fetchall()[0]
-            # Close connection
-            conn.close()
+            db_keys.setdefault(fpath, []).append((db_idx, i))
+
+        datasets = [None] * len(idxs)
+        for fpath, keys in db_keys.items():
+            positions = {}
+            for db_idx, i in keys:
+                positions.setdefault(db_idx, []).append(i)
+            # Older SQLite builds cap bound parameters at 999 per statement
+            db_idxs = list(positions)
+            for start in range(0, len(db_idxs), 999):
+                group = db_idxs[start : start + 999]
+                rows = self.get_connection(fpath).execute(
+                    "SELECT id, dataset, seq, pred_start FROM rows WHERE id IN (%s)"
+                    % ",".join("?" * len(group)),
+                    group,
+                ).fetchall()
+                for db_idx, dataset, seq, pred_start in rows:
+                    for i in positions[db_idx]:
+                        self._fill_row(fpath, seq, pred_start, tokens_np[i], weights_np[i])
+                        datasets[i] = dataset
+
+        return tokens, weights, datasets
+
+    def _fill_row(self, fpath, seq, pred_start, tokens, weights):
+        if self._raw_seq[fpath]:
+            fill_row(np.frombuffer(seq, dtype=np.int32), pred_start, self.pad_id, tokens, weights)
+        else:
+            buf = np.frombuffer(self.get_decompressor().decompress(seq), dtype=np.uint8)
+            parse_row(buf, pred_start, self.pad_id, tokens, weights)
 
-            tokens = [
-                int(x)
-                for x in self.get_decompressor()
-                .decompress(seq)
-                .decode(encoding="ASCII")
-                .split()
-            ]
 
-            weights = [0] * (pred_start - 1) + [1] * (len(tokens) - pred_start)
-            weights += [0] * (self.max_seq_len - len(weights))
+@torch.compile(fullgraph=True, dynamic=False)
+def split_batch(batch):
+    # Shift into inputs/targets and build the padding mask on the device as one fused kernel,
+    # writing contiguous x, y and mask instead of strided views plus a separate mask pass.
+    # Token ids travel as int32, embeddings index with them directly but the loss wants int64 targets.
+    x = batch[:, :-1].contiguous()
+    y = batch[:, 1:].long()
+    mask = x.ne(0).to(torch.uint8)
+    return x, y, mask
 
-            tokens = tokens + [self.pad_id] * (self.max_seq_len + 1 - len(tokens))
 
-            return np.asarray(tokens), np.asarray(weights), dataset
-        except Exception as e:
-            logging.error(f"idx: {idx} ")
-            raise
+def collate_batch(batch):
+    # `PileRandomIODataset.__getitems__` already returns the stacked batch.
+    return batch
+
+
+def worker_init_fn(worker_id):
+    # Connections must not be shared across the fork, every worker opens its own on first use.
+    dataset = torch.utils.data.get_worker_info().dataset
+    dataset._conns = {}
+    dataset._raw_seq = {}
 
 
 @DATAMODULE_REGISTRY
@@ -119,28 +256,20 @@ class Pile(LightningDataModule):
         self.save_hyperparameters()
 
     def setup(self, stage: Optional[str] = None) -> None:
-        if stage == "fit":
-            train_path = os.path.join(self.path, "train")
-            val_path = os.path.join(self.path, "val")
-
-            train_paths = sorted(
-                [
-                    os.path.join(train_path, x)
-                    for x in os.listdir(train_path)
-                    if x.endswith("db")
-                ]
-            )
+        # Compile (or load from the numba cache) the row parsers before workers fork.
+        parse_row(
+            np.frombuffer(b"1 2", dtype=np.uint8), 1, 0, np.empty(3, dtype=np.int32), np.empty(2, dtype=np.uint8)
+        )
+        fill_row(np.arange(2, dtype=np.int32), 1, 0, np.empty(3, dtype=np.int32), np.empty(2, dtype=np.uint8))
+
+        # Lightning may call setup again for later stages, the DB listing and row counts are only done once.
+        if stage == "fit" and self.train_dataset is None:
+            train_paths = sorted(glob.glob(os.path.join(self.path, "train", "*.db")))
             self.train_dataset = PileRandomIODataset(
                 train_paths, self.max_seq_len, self.tokenizer.pad_token_id
             )
 
-            val_paths = sorted(
-                [
-                    os.path.join(val_path, x)
-                    for x in os.listdir(val_path)
-                    if x.endswith("db")
-                ]
-            )
+            val_paths = sorted(glob.glob(os.path.join(self.path, "val", "*.db")))
             self.val_dataset = PileRandomIODataset(
                 val_paths, self.max_seq_len, self.tokenizer.pad_token_id
             )
@@ -152,11 +281,25 @@ class Pile(LightningDataModule):
             num_workers=30,
             drop_last=True,
             shuffle=True,
+            collate_fn=collate_batch,
+            worker_init_fn=worker_init_fn,
+            # Keep workers (and their DB connections) alive across epochs and prefetch deeper to hide row reads.
+            persistent_workers=True,
+            prefetch_factor=8,
+            pin_memory=True,
         )
 
     def val_dataloader(self) -> EVAL_DATALOADERS:
         return DataLoader(
-            self.val_dataset, batch_size=self.batch_size, num_workers=30, drop_last=True
+            self.val_dataset,
+            batch_size=self.batch_size,
+            num_workers=30,
+            drop_last=True,
+            collate_fn=collate_batch,
+            worker_init_fn=worker_init_fn,
+            persistent_workers=True,
+            prefetch_factor=8,
+            pin_memory=True,
         )
 
     def predict_dataloader(self) -> EVAL_DATALOADERS:
@@ -164,6 +307,5 @@ class Pile(LightningDataModule):
 
     def on_after_batch_transfer(self, batch, dataloader_idx):
         batch, weights, dataset = batch
-        x, y = batch[:, :-1], batch[:, 1:]
-        mask = x != 0
-        return x, y, mask.type(torch.uint8), weights, dataset
\ No newline at end of file
+        x, y, mask = split_batch(batch)
+        return x, y, mask, weights, dataset
\ No newline at end of file
@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, Dataset
 from torch.nn import functional as F
+import torch.utils.checkpoint
 from einops import rearrange, repeat
 from tqdm import tqdm
 from transformers.modeling_utils import PreTrainedModel
@@ -41,9 +42,10 @@ def print_tensor_info(tensor_name, tensor):
 
 
 
-USE_MAMBA = 1
-USE_TRANSFORMER = ~USE_MAMBA
-DIFFERENT_H_STATES_RECURRENT_UPDATE_MECHANISM = 0
+# Backbone selection, 'mamba' or 'transformer'
+MODEL_BACKBONE = os.environ.get('MIVRA_BACKBONE', 'mamba')
+USE_MAMBA = MODEL_BACKBONE == 'mamba'
+USE_TRANSFORMER = not USE_MAMBA
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -52,19 +54,66 @@ d_model = 16
 state_size = 1024  # Example state size
 seq_len = 100  # Example sequence length
 batch_size = 128  # Example batch size
+ssm_chunk_size = 50  # Sequence chunk streamed through the S6 scan, None scans the whole sequence at once.
+                     # A divisor of seq_len avoids padding the last chunk
+
+
+def selective_scan(a, b, dim=1):
+    """Inclusive scan of the recurrence h_t = a_t * h_{t-1} + b_t along `dim` with h_{-1} = 0.
+
+    Pairs compose as (a1, b1) then (a2, b2) -> (a2 * a1, a2 * b1 + b2), applied with doubling
+    offsets so the depth is log2(L) instead of L. Returns the cumulative products of `a` and the states.
+    """
+    length = a.shape[dim]
+    offset = 1
+    while offset < length:
+        a_prev, b_prev = a.narrow(dim, 0, length - offset), b.narrow(dim, 0, length - offset)
+        a_cur, b_cur = a.narrow(dim, offset, length - offset), b.narrow(dim, offset, length - offset)
+        b = torch.cat([b.narrow(dim, 0, offset), a_cur * b_prev + b_cur], dim=dim)
+        a = torch.cat([a.narrow(dim, 0, offset), a_cur * a_prev], dim=dim)
+        offset *= 2
+    return a, b
+
+
+# A free function rather than an S6 method, so dynamo guards only on tensor shapes and not on each
+# S6 instance. Called with fixed (batch_size, ssm_chunk_size, d_model, state_size) shapes, since
+# S6.forward pads the sequence to whole chunks and always passes a state, so max-autotune tunes
+# once per model shape. Without chunking it specializes on each new sequence length.
+@torch.compile(mode="max-autotune", dynamic=False, fullgraph=True)
+def ssm_step(delta, B, C, x, h, A_log):
+    # Discretization and state update traced as one graph, so inductor fuses the exp,
+    # the broadcast multiplies and the accumulation instead of writing out each [B,D,N,L] tensor
+    out_dtype = x.dtype
+    delta, B, C, x = delta.float(), B.float(), C.float(), x.float()
+    dA, dB = S6.discretization(delta, B, A_log)
+
+    # h_t = dA_t * h_{t-1} + dB_t * x_t over the innermost time axis,
+    # continuing from the [batch, d_model, state_size] initial state h
+    dA_cumprod, h_new = selective_scan(dA, x.transpose(1, 2).unsqueeze(2) * dB, dim=-1)
+    h_new = h_new + dA_cumprod * h.unsqueeze(-1)
+
+    # y needs to have a shape of [batch_size, seq_len, d_model]
+    y = torch.einsum('bln,bdnl->bld', C, h_new).to(out_dtype)
+
+    # Only the state after the last position leaves the step, copied out so the caller does not keep
+    # the whole [batch_size, d_model, state_size, seq_len] tensor alive through a view
+    return y, h_new[..., -1].contiguous()
 
 
 class S6(nn.Module):
-    def __init__(self, seq_len, d_model, state_size, device):
+    def __init__(self, seq_len, d_model, state_size, device, dtype=torch.float32, chunk_size=None):
         super(S6, self).__init__()
 
-        self.fc1 = nn.Linear(d_model, d_model, device=device)
-        self.fc2 = nn.Linear(d_model, state_size, device=device)
-        self.fc3 = nn.Linear(d_model, state_size, device=device)
+        # projections are stored in `dtype`, A_log and the state update stay in float32.
+        # bfloat16 weights are opt-in, without an fp32 master copy small AdamW updates round away
+        self.fc1 = nn.Linear(d_model, d_model, device=device, dtype=dtype)
+        self.fc2 = nn.Linear(d_model, state_size, device=device, dtype=dtype)
+        self.fc3 = nn.Linear(d_model, state_size, device=device, dtype=dtype)
 
         self.seq_len = seq_len
         self.d_model = d_model
         self.state_size = state_size
+        self.chunk_size = chunk_size
 
         #self.A = nn.Parameter(torch.ones(d_model, state_size, device=device))
         #self.A = nn.Parameter(F.normalize(torch.ones(d_model, state_size, device=device), p=2, dim=-1))
@@ -83,28 +132,19 @@ class S6(nn.Module):
         self.A_log = nn.Parameter(A_log)
         self.A_log._no_weight_decay = True
 
-        self.A = torch.zeros_like(self.A_log)
-        self.B = torch.zeros(batch_size, self.seq_len, self.state_size, device=device)
-        self.C = torch.zeros(batch_size, self.seq_len, self.state_size, device=device)
-
-        #self.delta = torch.zeros(batch_size, self.seq_len, self.d_model, device=device)
-        # Initialize delta parameter using a uniform distribution and apply the inverse softplus
-        uniform_distribution = torch.distributions.Uniform(0.001, 0.1)
-        # Sample from the uniform distribution and then apply the inverse softplus
-        self.delta = self.inverse_softplus(uniform_distribution.sample((batch_size, self.seq_len, self.d_model)))
-
-        self.dA = torch.zeros(batch_size, self.seq_len, self.d_model, self.state_size, device=device)
-        self.dB = torch.zeros(batch_size, self.seq_len, self.d_model, self.state_size, device=device)
-
-        # h should have dimensions [batch_size, seq_len, d_model, state_size]
-        self.h = torch.zeros(batch_size, self.seq_len, self.d_model, self.state_size, device=device)
-        self.y = torch.zeros(batch_size, self.seq_len, self.d_model, device=device)
+        # Initialize delta's bias by sampling from a uniform distribution and applying the inverse softplus,
+        # one value per channel so softplus(fc1(x)) starts in [0.001, 0.1]
+        with torch.no_grad():
+            delta = torch.empty(d_model, device=device).uniform_(0.001, 0.1)
+            self.fc1.bias.copy_(self.inverse_softplus(delta))
 
 
     def inverse_softplus(self, y):
-        return torch.log(torch.exp(y) - 1)
+        # log(exp(y) - 1) rewritten to avoid the cancellation in exp(y) - 1 for small y
+        return y + torch.log(-torch.expm1(-y))
 
-    def discretization(self):
+    @staticmethod
+    def discretization(delta, B, A_log):
         # discretization function is defined based on the MAMBA paper's description using ZOH on page 28
         # in Section C : Mechanics on Selective SSMs
         # See also "Zero-order hold discretization" maths proof inside https://studywolf.wordpress.com/tag/zero-order-hold/
@@ -128,99 +168,77 @@ class S6(nn.Module):
         Credit: Claude2 AI chatbot
         """
 
-        # For numerical stability during training process
-        self.A = -torch.exp(self.A_log.float())  # (d_model, state_size)
-
-        #print(f"self.A.shape = {self.A.shape}")
-        #print(f"self.B.shape = {self.B.shape}")
-        #print(f"self.delta.shape = {self.delta.shape}")
+        # dA and dB are laid out as [batch_size, d_model, state_size, seq_len] so the scan streams
+        # the time axis contiguously
+        delta = delta.transpose(1, 2).unsqueeze(2)  # [batch_size, d_model, 1, seq_len]
 
         # inverse() only supports square matrix
         #dB = torch.matmul(torch.inverse(A * delta), torch.matmul(dA - torch.eye(A.shape[0]), B))
-        self.dB = torch.einsum("bld,bln->bldn", self.delta, self.B)
+        dB = delta * B.transpose(1, 2).unsqueeze(1)
 
         # https://github.com/state-spaces/mamba/blob/0131c1e94a46fc9f70bcfc9d57962963bb2f0b9e/mamba_ssm/modules/mamba_simple.py#L240
-        #dA = torch.matrix_exp(A * delta)  # matrix_exp() only supports square matrix
-        self.dA = torch.exp(torch.einsum("bld,dn->bldn", self.delta, self.A))
-        #print(f"self.dA.shape = {self.dA.shape}")
-        #print(f"self.dA.requires_grad = {self.dA.requires_grad}")
+        # A = -exp(A_log) for numerical stability, the negation is folded into the same pointwise expression
+        dA = torch.exp(-delta * torch.exp(A_log.float()).unsqueeze(-1))
 
-        return self.dA, self.dB
+        return dA, dB
 
-    def forward(self, x):
+    def forward(self, x, h=None):
         # Refer to Algorithm 2 in the MAMBA paper
-        self.B = self.fc2(x)
-        self.C = self.fc3(x)
+        # h is an optional [batch_size, d_model, state_size] state to continue from,
+        # the state after the last position is returned alongside y
+        B = self.fc2(x)
+        C = self.fc3(x)
 
         # "a large ∆ resets the state `h` and focuses on the current input `x`,
         # while a small ∆ persists the state and ignores the current input."
-        self.delta = F.softplus(self.fc1(x))
-
-        # Uses ZOH as in MAMBA, Hungry Hippo still uses bilinear transform for discretization
-        self.discretization()
+        delta = F.softplus(self.fc1(x))
 
-        if DIFFERENT_H_STATES_RECURRENT_UPDATE_MECHANISM:  # this will trigger in-place runtime error if without using `h_new`
-            #print(f"self.dA = {self.dA}, self.dB = {self.dB}")
-            #print(f"self.dA.shape = {self.dA.shape}")
-            #print(f"self.dB.shape = {self.dB.shape}")
-            #print(f"x.shape = {x.shape}")
-            #print(f"self.h.shape = {self.h.shape}")
-            #print(f"self.C.shape = {self.C.shape}")
+        # A is diagonal: each of the d_model channels holds state_size independent eigenvalues,
+        # so exp(A * delta) is a pointwise exp and must not be swapped for torch.matrix_exp
+        assert self.A_log.shape == (self.d_model, self.state_size), "S6 expects a diagonal A stored as (d_model, state_size)"
 
-            global current_batch_size
-            current_batch_size = x.shape[0]
-
-            if self.h.shape[0] != current_batch_size:
-                #print("Adjusting h_new for the different batch size of input data `x`")
-                different_batch_size = True
-
-                # Resize self.h to match the current batch size
-                h_new =  torch.einsum('bldn,bldn->bldn', self.dA, self.h[:current_batch_size, ...]) + rearrange(x, "b l d -> b l d 1") * self.dB
+        # A zero state instead of None keeps a single signature for the compiled step
+        if h is None:
+            h = x.new_zeros(x.shape[0], self.d_model, self.state_size, dtype=torch.float32)
 
+        # Uses ZOH as in MAMBA, Hungry Hippo still uses bilinear transform for discretization
+        # discretization and the parallel scan over the sequence run inside the compiled `ssm_step`
+        # h has dimensions [batch_size, d_model, state_size, seq_len]
+        length = x.shape[1]
+        if self.chunk_size is None:
+            return ssm_step(delta, B, C, x, h, self.A_log)
+
+        # Right pad to a whole number of chunks so every chunk has the same shape. Padded steps have
+        # delta = 0, i.e. dA = 1 and dB = 0, so they carry the state through unchanged.
+        n_pad = -length % self.chunk_size
+        if n_pad:
+            delta, B, C, x = (F.pad(t, (0, 0, 0, n_pad)) for t in (delta, B, C, x))
+
+        # Stream the sequence in chunks, carrying the last state across chunk boundaries, so only
+        # [batch_size, d_model, state_size, chunk_size] state is live at a time. When training each chunk
+        # is checkpointed, autograd keeps only its inputs and recomputes the scan in the backward pass
+        ys = []
+        for start in range(0, length, self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            args = (delta[:, chunk], B[:, chunk], C[:, chunk], x[:, chunk], h, self.A_log)
+            if torch.is_grad_enabled():
+                y_chunk, h = torch.utils.checkpoint.checkpoint(ssm_step, *args, use_reentrant=False)
             else:
-                different_batch_size = False
-                h_new =  torch.einsum('bldn,bldn->bldn', self.dA, self.h) + rearrange(x, "b l d -> b l d 1") * self.dB
-
-            # y needs to have a shape of [batch_size, seq_len, d_model]
-            self.y = torch.einsum('bln,bldn->bld', self.C, h_new)
-
-            # Update self.h with the detached state of h_new
-            # Only do this if retaining gradients for self.h is not necessary for backprop
-            # Otherwise, store h_new in a temporary list and update self.h after the loop
-            global temp_buffer
-            temp_buffer = h_new.detach().clone() if not self.h.requires_grad else h_new.clone()
-            #print(f"temp_buffer.shape = {temp_buffer.shape}")
-
-            #print(f"self.y = {self.y}")
-            #print(f"self.dA.requires_grad = {self.dA.requires_grad}")
-            #print(f"self.dB.requires_grad = {self.dB.requires_grad}")
-            #print(f"self.C.requires_grad = {self.C.requires_grad}")
-            #print(f"self.h.requires_grad = {self.h.requires_grad}")
-            #print(f"self.y.requires_grad = {self.y.requires_grad}")
-
-            return self.y
+                y_chunk, h = ssm_step(*args)
+            ys.append(y_chunk)
 
-        else:  # this will not trigger in-place runtime error
-            # h should have dimensions [batch_size, seq_len, d_model, state_size]
-            h = torch.zeros(x.size(0), self.seq_len, self.d_model, self.state_size, device=x.device)
-            y = torch.zeros_like(x)
-
-            h =  torch.einsum('bldn,bldn->bldn', self.dA, h) + rearrange(x, "b l d -> b l d 1") * self.dB
-
-            # y needs to have a shape of [batch_size, seq_len, d_model]
-            y = torch.einsum('bln,bldn->bld', self.C, h)
-
-            return y
+        return torch.cat(ys, dim=1)[:, :length], h
 
 class MambaBlock(nn.Module):
-    def __init__(self, seq_len, d_model, state_size, device):
+    def __init__(self, seq_len, d_model, state_size, device, dtype=torch.float32, ssm_chunk_size=None):
         super(MambaBlock, self).__init__()
 
-        self.inp_proj = nn.Linear(d_model, 2*d_model, device=device)
-        self.out_proj = nn.Linear(2*d_model, d_model, device=device)
+        # projections and conv are stored in `dtype`, activations are cast at the block boundary
+        self.inp_proj = nn.Linear(d_model, 2*d_model, device=device, dtype=dtype)
+        self.out_proj = nn.Linear(2*d_model, d_model, device=device, dtype=dtype)
 
         # For residual skip connection
-        self.D = nn.Linear(d_model, 2*d_model, device=device)
+        self.D = nn.Linear(d_model, 2*d_model, device=device, dtype=dtype)
 
         # Set _no_weight_decay attribute on bias
         self.out_proj.bias._no_weight_decay = True
@@ -228,16 +246,27 @@ class MambaBlock(nn.Module):
         # Initialize bias to a small constant value
         nn.init.constant_(self.out_proj.bias, 1.0)
 
-        self.S6 = S6(seq_len, 2*d_model, state_size, device)
+        self.S6 = S6(seq_len, 2*d_model, state_size, device, dtype=dtype, chunk_size=ssm_chunk_size)
 
-        # Add 1D convolution with kernel size 3
-        self.conv = nn.Conv1d(seq_len, seq_len, kernel_size=3, padding=1, device=device)
+        # Add depthwise 1D convolution with kernel size 3 along the sequence axis,
+        # left padded in forward so it stays causal
+        self.conv = nn.Conv1d(2*d_model, 2*d_model, kernel_size=3, padding=0, groups=2*d_model, device=device, dtype=dtype)
 
         # rmsnorm
         self.norm = RMSNorm(d_model, device=device)
 
+    @torch.compile(dynamic=False)
+    def _conv_act(self, x_proj):
+        # Add 1D convolution with kernel size 3
+        # Padding only on the left keeps every output position from seeing later ones,
+        # so no causal mask has to be built and multiplied in afterwards
+        # Conv1d expects (batch_size, channels, seq_len)
+        x_conv = self.conv(F.pad(x_proj.transpose(1, 2), (self.conv.kernel_size[0] - 1, 0))).transpose(1, 2)
+
+        # the pad, transposes and silu are compiled together so inductor fuses them into the conv's prologue/epilogue
+        return F.silu(x_conv)  # Swish activation can be implemented as x * sigmoid(x)
 
-    def forward(self, x, attention_mask=None):
+    def forward(self, x, attention_mask=None, h=None):
 
         if attention_mask is not None:
             # Apply the attention mask
@@ -250,30 +279,16 @@ class MambaBlock(nn.Module):
         """
         # Refer to Figure 3 in the MAMBA paper
 
-        x = self.norm(x)
+        input_dtype = x.dtype
+        x = self.norm(x).to(self.inp_proj.weight.dtype)
 
         x_proj = self.inp_proj(x)
         #print(f"x_proj.shape = {x_proj.shape}")
 
-        # Add 1D convolution with kernel size 3
-        x_conv = self.conv(x_proj)
-
-        # Create a triangular mask of the same shape as the input sequence
-        mask = torch.tril(torch.ones(seq_len, 2*d_model, device=device))
-
-        # Add batch dimension with unsqueeze(0) -> (1, seq_len, seq_len)
-        # Repeat batch dim to match x_conv batches with .repeat()
-        current_batch_size = x.shape[0]
-        mask = mask.repeat(current_batch_size, 1, 1)
-
-        # Apply causal mask to zero out the masked regions
-        x_conv = x_conv * mask
-        #print(f"x_conv.shape = {x_conv.shape}")
-
-        x_conv_act = F.silu(x_conv)  # Swish activation can be implemented as x * sigmoid(x)
+        x_conv_act = self._conv_act(x_proj)
         #print(f"x_conv_act.shape = {x_conv_act.shape}")
 
-        x_ssm = self.S6(x_conv_act)
+        x_ssm, h = self.S6(x_conv_act, h)
         #print(f"x_ssm.shape = {x_ssm.shape}")
 
         # residual skip connection with nonlinearity introduced by multiplication
@@ -282,32 +297,42 @@ class MambaBlock(nn.Module):
         x_combined = x_ssm * x_residual
         #print(f"x_combined.shape = {x_combined.shape}")
 
-        x_out = self.out_proj(x_combined)
+        # out_proj as a single addmm over the flattened tokens, bias add fused into the GEMM
+        x_out = torch.addmm(
+            self.out_proj.bias, x_combined.reshape(-1, x_combined.shape[-1]), self.out_proj.weight.t()
+        ).view(*x_combined.shape[:-1], -1)
         #print(f"x_out.shape = {x_out.shape}")
 
-        return x_out
+        return x_out.to(input_dtype), h
 
 
 class Mamba(nn.Module):
-    def __init__(self, seq_len, d_model, state_size, vocab_size, device):
+    def __init__(self, seq_len, d_model, state_size, vocab_size, device, ssm_chunk_size=None):
         super(Mamba, self).__init__()
 
         if vocab_size is None:
             vocab_size = d_model
 
-        self.mamba_block1 = MambaBlock(seq_len, d_model, state_size, device)
-        self.mamba_block2 = MambaBlock(seq_len, d_model, state_size, device)
-        self.mamba_block3 = MambaBlock(seq_len, d_model, state_size, device)
+        self.mamba_block1 = MambaBlock(seq_len, d_model, state_size, device, ssm_chunk_size=ssm_chunk_size)
+        self.mamba_block2 = MambaBlock(seq_len, d_model, state_size, device, ssm_chunk_size=ssm_chunk_size)
+        self.mamba_block3 = MambaBlock(seq_len, d_model, state_size, device, ssm_chunk_size=ssm_chunk_size)
 
         self.final_proj = nn.Linear(d_model, vocab_size, device=device)
 
-    def forward(self, x, attention_mask=None):
-        x = self.mamba_block1(x, attention_mask)
-        x = self.mamba_block2(x, attention_mask)
-        x = self.mamba_block3(x, attention_mask)
+    def forward(self, x, attention_mask=None, states=None, return_states=False):
+        # `states` holds one S6 state per block to continue from, None starts every block from zero.
+        # Detach returned states before passing them back in if gradients should not flow across calls.
+        if states is None:
+            states = (None, None, None)
+
+        x, h1 = self.mamba_block1(x, attention_mask, states[0])
+        x, h2 = self.mamba_block2(x, attention_mask, states[1])
+        x, h3 = self.mamba_block3(x, attention_mask, states[2])
 
         x = self.final_proj(x)
 
+        if return_states:
+            return x, (h1, h2, h3)
         return x
 
 
@@ -332,7 +357,7 @@ class RMSNorm(nn.Module):
 if USE_MAMBA:
     x = torch.rand(batch_size, seq_len, d_model, device=device)
     # Create the Mamba model
-    mamba = Mamba(seq_len, d_model, state_size, None, device)
+    mamba = Mamba(seq_len, d_model, state_size, None, device, ssm_chunk_size=ssm_chunk_size)
 
     # rmsnorm
     norm = RMSNorm(d_model)
@@ -450,13 +475,6 @@ def train(model, tokenizer, data_loader, optimizer, criterion, device, max_grad_
                 else:
                     print(f"{name} has no gradient")
 
-        if USE_MAMBA and DIFFERENT_H_STATES_RECURRENT_UPDATE_MECHANISM:
-            # update self.h from temp_buffer
-            #print(f"temp_buffer = {temp_buffer}")
-            #print(f"temp_buffer.shape = {temp_buffer.shape}")
-            #print(f"current_batch_size = {current_batch_size}")
-            model.S6.h[:current_batch_size, ...].copy_(temp_buffer)
-
         optimizer.step()
 
         total_loss += loss.item()
@@ -668,7 +686,7 @@ elif USE_TRANSFORMER:
 
 
 # Initialize the model
-model = Mamba(seq_len, d_model, state_size, tokenizer.vocab_size, device).to(device)
+model = Mamba(seq_len, d_model, state_size, tokenizer.vocab_size, device, ssm_chunk_size=ssm_chunk_size).to(device)
 
 # model = ray.train.torch.prepare_model(model)
 optimizer = optim.AdamW(model.parameters(), lr=5e-6)
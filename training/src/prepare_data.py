@@ -8,9 +8,10 @@ from multiprocessing import Pool
 from typing import List, Optional
 from transformers import AutoTokenizer
 
+import numpy as np
 import zstandard
 
-from utils import get_rolling_token_windows
+from utils import RAW_SEQ_VERSION, get_rolling_token_windows
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -  %(message)s", level=logging.INFO
@@ -44,6 +45,8 @@ def prepare_data_worker(
     cursor.execute(
         "CREATE TABLE rows (id INTEGER PRIMARY KEY, dataset TEXT, seq BLOB, pred_start INTEGER)"
     )
+    # `seq` is stored as raw little-endian int32 token ids.
+    cursor.execute(f"PRAGMA user_version = {RAW_SEQ_VERSION}")
 
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
     # tokenizer.load(tokenizer_path)
@@ -51,7 +54,6 @@ def prepare_data_worker(
     with open(read_path, "rb") as fh:
         dctx = zstandard.ZstdDecompressor()
         data_stream = io.TextIOWrapper(dctx.stream_reader(fh), encoding="utf-8")
-        compressor = zstandard.ZstdCompressor()
         idx = 0
         for line in data_stream:
             obj = json.loads(line)
@@ -70,12 +72,9 @@ def prepare_data_worker(
             ):
                 seq = input_tokens + pred_tokens[-1:]
                 pred_start = len(seq) - len(pred_tokens)
-                compressed_seq = compressor.compress(
-                    " ".join([str(x) for x in seq]).encode(encoding="ASCII")
-                )
                 cursor.execute(
                     "INSERT INTO rows (id, dataset, seq, pred_start) VALUES (?, ?, ?, ?)",
-                    (idx, dataset, compressed_seq, pred_start),
+                    (idx, dataset, sqlite3.Binary(np.asarray(seq, dtype="<i4").tobytes()), pred_start),
                 )
                 idx += 1
                 if idx % 10000 == 0:
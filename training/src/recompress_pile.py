@@ -0,0 +1,83 @@
+import argparse
+import logging
+import os
+import sqlite3
+from multiprocessing import Pool
+
+import numpy as np
+import zstandard
+
+from utils import RAW_SEQ_VERSION
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -  %(message)s", level=logging.INFO
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directory", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, required=False, default=10000)
+
+    return parser
+
+
+def recompress_pile_worker(path: str, batch_size: int) -> None:
+    """
+    Rewrites the `seq` column of a DB produced by an older `prepare_data.py` from zstd compressed ASCII token ids
+    to raw little-endian int32 token ids, so reading a row no longer needs decompressing and parsing.
+    """
+    connection = sqlite3.connect(path)
+    if connection.execute("PRAGMA user_version").fetchall()[0][0] == RAW_SEQ_VERSION:
+        logging.info(f"{path} already stores raw token ids, skipping")
+        connection.close()
+        return
+
+    logging.info(f"Recompressing {path}")
+    dctx = zstandard.ZstdDecompressor()
+    # Page through the table by id rather than holding a cursor open over the rows being updated.
+    idx = 0
+    last_id = -1
+    while True:
+        rows = connection.execute(
+            "SELECT id, seq FROM rows WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = [
+            (
+                sqlite3.Binary(
+                    np.fromstring(dctx.decompress(seq), dtype=np.int32, sep=" ").astype("<i4").tobytes()
+                ),
+                row_id,
+            )
+            for row_id, seq in rows
+        ]
+        connection.executemany("UPDATE rows SET seq = ? WHERE id = ?", updates)
+        idx += len(rows)
+        logging.info(f"Recompressed {idx} rows from {path}")
+
+    connection.execute(f"PRAGMA user_version = {RAW_SEQ_VERSION}")
+    connection.commit()
+    connection.execute("VACUUM")
+    connection.close()
+    logging.info(f"Finished recompressing {path} with {idx} rows")
+
+
+def recompress_pile(directory: str, stage: str, batch_size: int):
+    directory = os.path.join(directory, stage)
+    paths = [os.path.join(directory, x) for x in os.listdir(directory) if x.endswith("db")]
+
+    with Pool(os.cpu_count()) as p:
+        p.starmap(recompress_pile_worker, [(x, batch_size) for x in paths])
+
+    logging.info(f"Finished recompressing {directory}")
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    cfg = parser.parse_args()
+
+    recompress_pile(cfg.directory, "train", cfg.batch_size)
+    recompress_pile(cfg.directory, "val", cfg.batch_size)
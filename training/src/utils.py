@@ -1,3 +1,8 @@
+# `PRAGMA user_version` of Pile DBs whose `seq` column holds raw little-endian int32 token ids. DBs with the
+# default version 0 hold zstd compressed, space separated ASCII token ids.
+RAW_SEQ_VERSION = 1
+
+
 # This is taken from https://github.com/EleutherAI/lm_perplexity. We will align to this method of producing model inputs
 # so we can compare to Pile evaluation numbers.
 def get_rolling_token_windows(token_list, prefix_token, max_seq_len, context_len):